@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Times and memory-profiles every sourcerer stage against synthetic OSSEM corpora"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sourcerer
+from sourcerer import ossemParser, attackCTI, iter_yaml, dump_yaml, CONFIG
+
+
+class corpusGenerator:
+    """Builds synthetic OSSEM corpora by replicating the bundled yaml models"""
+
+    def __init__(self, path):
+        self.ddm_list = list(iter_yaml(path+CONFIG['OSSEM_YAML_DDM']))
+        self.data_dictionaries = list(iter_yaml(path+CONFIG['OSSEM_YAML_DDS']))
+        self.cim_entities = list(iter_yaml(path+CONFIG['OSSEM_YAML_CIM']))
+
+    def generate(self, scale):
+        """ returns ddm, dictionaries and cim replicated scale times """
+        ddm_list = []
+        data_dictionaries = []
+        cim_entities = []
+
+        #copy 0 keeps the original names so the bundled profile still matches
+        for i in range(scale):
+            suffix = '-{}'.format(i) if i else ''
+
+            for dd in self.data_dictionaries:
+                dd = dict(dd)
+                dd['event'] = '{}{}'.format(dd['event'], suffix)
+                data_dictionaries.append(dd)
+
+            for row in self.ddm_list:
+                row = dict(row)
+                row['eventid'] = '{}{}'.format(row['eventid'], suffix)
+                ddm_list.append(row)
+
+            for entity in self.cim_entities:
+                entity = dict(entity)
+                entity['entity'] = '{}{}'.format(entity['entity'], suffix)
+                cim_entities.append(entity)
+
+        return ddm_list, data_dictionaries, cim_entities
+
+    def write_yaml(self, path, scale):
+        """ writes a yaml corpus readable by ossemParser.parse_yaml """
+        ddm_list, data_dictionaries, cim_entities = self.generate(scale)
+        os.makedirs(path, exist_ok=True)
+        dump_yaml(ddm_list, os.path.join(path, CONFIG['OSSEM_YAML_DDM']))
+        dump_yaml(data_dictionaries, os.path.join(path, CONFIG['OSSEM_YAML_DDS']))
+        dump_yaml(cim_entities, os.path.join(path, CONFIG['OSSEM_YAML_CIM']))
+
+    def md_table(self, headers, rows):
+        """ returns a markdown table """
+        lines = [
+            '| {} |'.format(' | '.join(h.title() for h in headers)),
+            '|{}|'.format('|'.join('---' for h in headers))]
+        for row in rows:
+            cells = [str(row.get(h) or '').replace('|', '/').replace('\n', ' ') for h in headers]
+            lines.append('| {} |'.format(' | '.join(cells)))
+        return '\n'.join(lines) + '\n'
+
+    def write_markdown(self, path, scale):
+        """ writes a markdown tree readable by ossemParser.parse_markdown """
+        ddm_list, data_dictionaries, cim_entities = self.generate(scale)
+
+        cim_path = os.path.join(path, 'common_information_model')
+        os.makedirs(cim_path, exist_ok=True)
+        for entity in cim_entities:
+            with open(os.path.join(cim_path, entity['entity'] + '.md'), 'w') as md_file:
+                md_file.write('# {}\n\n{}\n\n## Data Fields\n\n{}'.format(
+                    entity['entity'], entity.get('description') or entity['entity'],
+                    self.md_table(['standard name', 'type', 'description', 'sample value'],
+                        entity['data fields'])))
+
+        for dd in data_dictionaries:
+            dd_path = os.path.join(path, 'data_dictionaries', dd['operating system'], dd['data channel'])
+            os.makedirs(dd_path, exist_ok=True)
+            with open(os.path.join(dd_path, 'event-{}.md'.format(dd['event'])), 'w') as md_file:
+                md_file.write('# {}\n\n## Description\n{}\n\n## Data Dictionary\n\n{}'.format(
+                    dd['event'], dd.get('description') or dd['event'],
+                    self.md_table(['standard name', 'field name', 'type', 'description', 'sample value'],
+                        dd['data fields'])))
+
+        ddm_path = os.path.join(path, 'detection_data_model')
+        os.makedirs(ddm_path, exist_ok=True)
+        with open(os.path.join(ddm_path, 'ddm.md'), 'w') as md_file:
+            md_file.write('# DDM\n\n{}'.format(self.md_table([
+                'att&ck data source', 'sub data source', 'source data object',
+                'relationship', 'destination data object', 'eventid'], ddm_list)))
+
+    def write_bundle(self, path, scale):
+        """ writes a stand-in ATT&CK STIX bundle using the ddm data sources """
+        data_sources = sorted(set(
+            ds.strip() for row in self.ddm_list for ds in str(row['att&ck data source']).split(',')))
+
+        objects = []
+        for i in range(200 * scale):
+            objects.append({
+                'type': 'attack-pattern',
+                'name': 'Technique {}'.format(i),
+                'external_references': [{'source_name': 'mitre-attack', 'external_id': 'T{}'.format(1000 + i)}],
+                'x_mitre_platforms': ['Windows'],
+                'kill_chain_phases': [{'kill_chain_name': 'mitre-attack', 'phase_name': 'execution'}],
+                'x_mitre_data_sources': [data_sources[(i + j) % len(data_sources)] for j in range(i % 4 + 1)]})
+
+        with open(path, 'w') as bundle_file:
+            json.dump({'type': 'bundle', 'objects': objects}, bundle_file)
+
+
+def measure(stage, scale, func, memory=True):
+    """ runs a stage, returns its result and a timing/memory record """
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    #tracing allocations slows the stage down, so memory is taken from a second run
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    records = len(result) if isinstance(result, (list, dict)) else None
+    print('[*] {:>4}x {:<20} {:8.3f}s {:8.1f} MB'.format(scale, stage, elapsed, peak / 1024 / 1024))
+    return result, {
+        'scale': scale,
+        'stage': stage,
+        'seconds': elapsed,
+        'peak_memory': peak,
+        'records': records}
+
+
+#heavy dependencies each output mode may pull in, anything else loaded is a regression
+STARTUP_MODES = {
+    'import': [],
+    'yaml': [],
+    'layer': [],
+    'excel': ['openpyxl', 'lxml'],
+    'markdown': ['mistune'],
+    'parquet': ['pyarrow'],
+    'ndjson': [],
+    #the 7.x client loads its requests connection and async helpers on import
+    'elastic': ['elasticsearch', 'requests', 'asyncio'],
+    'serve': ['asyncio']}
+
+HEAVY_MODULES = ['mistune', 'bs4', 'lxml', 'attackcti', 'elasticsearch', 'openpyxl', 'requests', 'asyncio', 'pyarrow']
+
+STARTUP_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+import sourcerer
+elapsed = time.perf_counter() - start
+mode, profile, yaml_path, md_path, bundle, output = sys.argv[1:]
+ossem = sourcerer.ossemParser(profile)
+if mode == 'markdown':
+    ossem.parse_markdown(md_path)
+elif mode != 'import':
+    ossem.parse_yaml(yaml_path)
+    ossem.enrich_ddm()
+if mode == 'yaml':
+    ossem.export_to_yaml(output)
+elif mode == 'excel':
+    ossem.export_to_xlsx(output)
+elif mode == 'layer':
+    sourcerer.attackCTI(ossem.get_ds_scores(), bundle=bundle).get_ds_quality_layer()
+elif mode == 'parquet':
+    ossem.export_to_parquet(output)
+elif mode == 'ndjson':
+    ossem.export_to_ndjson(output + 'ossem.ndjson')
+elif mode == 'elastic':
+    #documents are only sent on export, the client is built without a server
+    sourcerer.Elastic()
+elif mode == 'serve':
+    import asyncio
+    service = sourcerer.scoringService(ossem, ('yaml', yaml_path), {'default': profile},
+        sourcerer.attackCTI({}, bundle=bundle))
+    service.states = service.reload({'default'})
+    service.route('GET', '/layer')
+print(json.dumps({'seconds': elapsed, 'modules': sorted(m for m in sys.modules if '.' not in m)}))
+'''
+
+
+def startup(generator, profile, workdir, budget):
+    """ runs every output mode in a fresh interpreter, returns records and the failed checks """
+    yaml_path = os.path.join(workdir, 'yaml') + os.sep
+    md_path = os.path.join(workdir, 'md')
+    bundle = os.path.join(workdir, 'attack.json')
+    output = os.path.join(workdir, 'output') + os.sep
+    generator.write_yaml(yaml_path, 1)
+    generator.write_markdown(md_path, 1)
+    generator.write_bundle(bundle, 1)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(sourcerer.__file__)), env.get('PYTHONPATH')]))
+
+    results = []
+    failures = []
+    for mode, allowed in STARTUP_MODES.items():
+        #the best of a few runs, the first one pays for cold disk caches
+        timings = []
+        for i in range(3):
+            proc = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, mode, profile, yaml_path, md_path, bundle, output],
+                env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            result = json.loads(proc.stdout.splitlines()[-1])
+            timings.append(result['seconds'])
+
+        loaded = [m for m in HEAVY_MODULES if m in result['modules'] and m not in allowed]
+        elapsed = min(timings)
+        print('[*] startup {:<10} {:8.3f}s {}'.format(mode, elapsed, ' '.join(loaded)))
+
+        if loaded:
+            failures.append('{} mode imports {}'.format(mode, ', '.join(loaded)))
+        if elapsed > budget:
+            failures.append('{} mode import took {:.3f}s, budget is {:.3f}s'.format(mode, elapsed, budget))
+
+        results.append({'stage': 'startup', 'mode': mode, 'seconds': elapsed, 'modules': loaded})
+
+    return results, failures
+
+
+def service_check(generator, profile, workdir, platform='windows'):
+    """ runs the scoring service on a yaml corpus and edits the corpus, returns records and the failed checks """
+    yaml_path = os.path.join(workdir, 'yaml') + os.sep
+    bundle = os.path.join(workdir, 'attack.json')
+    ddm_path = yaml_path + CONFIG['OSSEM_YAML_DDM']
+    generator.write_yaml(yaml_path, 1)
+    generator.write_bundle(bundle, 1)
+
+    ossem = ossemParser(profile)
+    ossem.parse_yaml(yaml_path)
+    ossem.set_platform(platform)
+    service = sourcerer.scoringService(ossem, ('yaml', yaml_path), {'default': profile},
+        attackCTI({}, bundle=bundle), interval=0.1, platform=platform)
+
+    async def check():
+        server = asyncio.ensure_future(service.run('127.0.0.1', 0))
+        while not service.states:
+            await asyncio.sleep(0.05)
+        before = service.route('GET', '/status')[1]['ddm']
+
+        #dropping a ddm row has to be picked up by reparsing the corpus
+        dump_yaml(list(iter_yaml(ddm_path))[:-1], ddm_path)
+        start = time.perf_counter()
+        while service.route('GET', '/status')[1]['ddm'] == before and time.perf_counter() - start < 10:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+        return before, service.route('GET', '/status')[1]['ddm'], elapsed
+
+    before, after, elapsed = asyncio.run(check())
+    print('[*] service reload {:8.3f}s {} -> {} ddm rows'.format(elapsed, before, after))
+
+    failures = []
+    if after != before - 1:
+        failures.append('service did not reload the changed ddm, {} rows instead of {}'.format(after, before - 1))
+    if service.ossem.platform != platform:
+        failures.append('service reload dropped platform {}'.format(platform))
+
+    return [{'stage': 'service_reload', 'seconds': elapsed, 'records': after}], failures
+
+
+class standInElastic(BaseHTTPRequestHandler):
+    """Answers the elasticsearch calls sourcerer makes from memory and counts them"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def resolve(self, name):
+        """ returns the index behind an alias """
+        for index, aliases in self.server.aliases.items():
+            if name in aliases:
+                return index
+        return name
+
+    def bulk(self, lines):
+        """ applies bulk actions, every item fails while the server is failing """
+        items = []
+        while lines:
+            action = json.loads(lines.pop(0))
+            op_type, meta = next(iter(action.items()))
+            docs = self.server.indices.setdefault(self.resolve(meta['_index']), {})
+            source = json.loads(lines.pop(0)) if op_type != 'delete' else None
+
+            if self.server.failing:
+                status = 500
+            elif op_type == 'delete':
+                status = 200 if docs.pop(meta['_id'], None) is not None else 404
+            else:
+                docs[meta.get('_id') or str(len(docs))] = source
+                status = 201
+            items.append({op_type: {'_index': meta['_index'], '_id': meta.get('_id'), 'status': status,
+                'error': {'type': 'stand_in_failure'} if status == 500 else None}})
+
+        self.server.bulk_items += len(items)
+        return {'took': 1, 'errors': any(list(item.values())[0]['status'] >= 300 for item in items), 'items': items}
+
+    def handle_request(self):
+        path = self.path.split('?')[0]
+        parts = [part for part in path.split('/') if part]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        self.server.requests += 1
+        indices = self.server.indices
+        aliases = self.server.aliases
+
+        if not parts:
+            return self.reply(200, {'version': {'number': '7.10.0', 'build_flavor': 'default'},
+                'tagline': 'You Know, for Search'})
+        if parts[-1] == '_bulk':
+            self.server.bulk_requests += 1
+            return self.reply(200, self.bulk([line for line in body.split('\n') if line]))
+        if parts[0] == '_alias':
+            found = dict((index, {'aliases': {parts[1]: {}}}) for index, names in aliases.items() if parts[1] in names)
+            return self.reply(200 if found else 404, found)
+        if parts[0] == '_aliases':
+            for action in json.loads(body)['actions']:
+                for op_type, alias in action.items():
+                    names = aliases.setdefault(alias['index'], set())
+                    (names.add if op_type == 'add' else names.discard)(alias['alias'])
+            return self.reply(200, {'acknowledged': True})
+
+        index = parts[0]
+        if len(parts) == 1 and self.command == 'HEAD':
+            return self.reply(200 if index in indices or self.resolve(index) != index else 404)
+        if len(parts) == 1 and self.command == 'PUT':
+            indices[index] = {}
+        elif len(parts) == 1 and self.command == 'DELETE':
+            if index not in indices:
+                return self.reply(404, {'error': 'index_not_found_exception', 'status': 404})
+            del indices[index]
+            aliases.pop(index, None)
+        return self.reply(200, {'acknowledged': True})
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+
+def elastic_check(generator, profile, workdir):
+    """ exports a yaml corpus into a stand-in elasticsearch, returns records and the failed checks """
+    yaml_path = os.path.join(workdir, 'yaml') + os.sep
+    generator.write_yaml(yaml_path, 1)
+    ossem = ossemParser(profile)
+    ossem.parse_yaml(yaml_path)
+    ossem.enrich_ddm()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), standInElastic)
+    server.indices = {}
+    server.aliases = {}
+    server.failing = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    CONFIG.load()
+    CONFIG['ELASTIC_SERVER'] = '127.0.0.1'
+    CONFIG['ELASTIC_PORT'] = server.server_port
+    CONFIG['ELASTIC_MANIFEST'] = os.path.join(workdir, 'elastic_manifest.json')
+
+    results = []
+    def export(name, func):
+        server.requests = server.bulk_requests = server.bulk_items = 0
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            pass
+        elapsed = time.perf_counter() - start
+        print('[*] elastic {:<16} {:8.3f}s {:4} requests {:4} bulk requests {:6} bulk items'.format(
+            name, elapsed, server.requests, server.bulk_requests, server.bulk_items))
+        results.append({'stage': 'elastic', 'mode': name, 'seconds': elapsed, 'requests': server.requests,
+            'bulk_requests': server.bulk_requests, 'records': server.bulk_items})
+        return server.bulk_items
+
+    def drop_row():
+        ossem.ddm_list = ossem.ddm_list[:-1]
+        ossem.export_to_elastic()
+
+    failures = []
+    try:
+        export('rebuild', lambda: ossem.export_to_elastic(rebuild=True))
+        if export('unchanged sync', ossem.export_to_elastic):
+            failures.append('elastic sync of an unchanged corpus sent documents')
+
+        #a removed row that fails to sync has to be deleted again by the next sync
+        server.failing = True
+        export('failed sync', drop_row)
+        server.failing = False
+        if export('retried sync', ossem.export_to_elastic) != 1:
+            failures.append('elastic sync did not retry the failed delete')
+
+        #a document already gone from the index counts as deleted and is not sent again
+        last = ossem.ddm_list[-1]
+        docs = server.indices[next(index for index, names in server.aliases.items() if 'ossem.ddm' in names)]
+        del docs[[doc_id for doc_id, doc in docs.items()
+            if (doc.get('eventid'), doc.get('data channel')) == (last.get('eventid'), last.get('data channel'))][-1]]
+        export('missing delete', drop_row)
+        if export('resync', ossem.export_to_elastic):
+            failures.append('elastic sync resent the delete of a missing document')
+
+        #a failed rebuild must not leave its new index behind
+        indices = set(server.indices)
+        server.failing = True
+        export('failed rebuild', lambda: ossem.export_to_elastic(rebuild=True))
+        server.failing = False
+        if set(server.indices) != indices:
+            failures.append('failed elastic rebuild left {} behind'.format(', '.join(sorted(set(server.indices) - indices))))
+    finally:
+        server.shutdown()
+        server.server_close()
+        CONFIG.loaded = False
+        CONFIG.clear()
+
+    return results, failures
+
+
+def run(generator, scale, profile, workdir, stages, memory=True):
+    """ benchmarks every selected stage at one scale """
+    results = []
+    yaml_path = os.path.join(workdir, 'yaml') + os.sep
+    md_path = os.path.join(workdir, 'md')
+    bundle = os.path.join(workdir, 'attack.json')
+
+    generator.write_yaml(yaml_path, scale)
+    generator.write_bundle(bundle, scale)
+    if 'parse_markdown' in stages:
+        generator.write_markdown(md_path, scale)
+
+    def stage(name, func):
+        if name not in stages:
+            return None
+        result, record = measure(name, scale, func, memory)
+        results.append(record)
+        return result
+
+    ossem = ossemParser(profile)
+    stage('parse_markdown', lambda: ossemParser(profile).parse_markdown(md_path))
+    ossem.parse_yaml(yaml_path)
+    stage('parse_yaml', lambda: ossemParser(profile).parse_yaml(yaml_path))
+
+    #enrichment skips unchanged rows, reset it so the stage times a full pass
+    ossem.enrich_ddm()
+    stage('enrich_ddm', lambda: (ossem.reset_enrichment(), ossem.enrich_ddm())[1])
+    ds_scores = stage('get_ds_scores', ossem.get_ds_scores) or ossem.get_ds_scores()
+    stage('get_cim_entities', ossem.get_cim_entities)
+    stage('get_dd_list', ossem.get_dd_list)
+
+    attack = attackCTI(ds_scores, bundle=bundle)
+    stage('get_ds_quality_layer', lambda: attack.get_ds_quality_layer()['techniques'])
+
+    output = os.path.join(workdir, 'output') + os.sep
+    stage('export_to_yaml', lambda: ossem.export_to_yaml(output))
+    stage('export_to_xlsx', lambda: ossem.export_to_xlsx(output, extra_sheets=True))
+
+    return results
+
+
+if __name__ == "__main__":
+    stages = [
+        'parse_markdown',
+        'parse_yaml',
+        'enrich_ddm',
+        'get_ds_scores',
+        'get_cim_entities',
+        'get_dd_list',
+        'get_ds_quality_layer',
+        'export_to_yaml',
+        'export_to_xlsx']
+
+    parser = argparse.ArgumentParser(description='Benchmark sourcerer stages on synthetic OSSEM corpora.')
+    parser.add_argument('-y', '--ossem-yaml',
+        help='path to the OSSEM yaml used as seed corpus',
+        default='resources/')
+    parser.add_argument('-p', '--profile',
+        help='path to CIM profile',
+        default='profiles/default.yml')
+    parser.add_argument('-s', '--scales',
+        help='corpus sizes, as multiples of the seed corpus',
+        type=int,
+        nargs='+',
+        default=[1, 10, 100])
+    parser.add_argument('--stages',
+        help='stages to benchmark',
+        nargs='+',
+        choices=stages,
+        default=stages)
+    parser.add_argument('--no-memory',
+        help='skip the traced run used to measure peak memory',
+        action='store_true')
+    parser.add_argument('--startup',
+        help='only check import time and imported dependencies of each output mode, exits with an error on regressions',
+        action='store_true')
+    parser.add_argument('--startup-budget',
+        help='maximum seconds importing sourcerer may take',
+        type=float,
+        default=0.2)
+    parser.add_argument('--service',
+        help='only check the scoring service reloads a changed corpus, exits with an error on failure',
+        action='store_true')
+    parser.add_argument('--elastic',
+        help='only check elastic exports against a stand-in server that counts requests, exits with an error on failure',
+        action='store_true')
+    parser.add_argument('-o', '--output',
+        help='path of the json results',
+        default='output/benchmark_{}.json'.format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    args = parser.parse_args()
+
+    generator = corpusGenerator(args.ossem_yaml)
+    results = []
+    failures = []
+    checks = []
+    if args.startup:
+        checks.append(lambda workdir: startup(generator, args.profile, workdir, args.startup_budget))
+    if args.service:
+        checks.append(lambda workdir: service_check(generator, args.profile, workdir))
+    if args.elastic:
+        checks.append(lambda workdir: elastic_check(generator, args.profile, workdir))
+
+    for check in checks:
+        workdir = tempfile.mkdtemp(prefix='sourcerer_bench_')
+        try:
+            check_results, check_failures = check(workdir)
+            results += check_results
+            failures += check_failures
+        finally:
+            shutil.rmtree(workdir)
+
+    for scale in ([] if checks else args.scales):
+        workdir = tempfile.mkdtemp(prefix='sourcerer_bench_')
+        try:
+            results += run(generator, scale, args.profile, workdir, args.stages, not args.no_memory)
+        finally:
+            shutil.rmtree(workdir)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'version': sourcerer.__version__,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'date': datetime.now().isoformat(),
+            'results': results}, output_file, indent=2)
+
+    print('[*] Saved benchmark results to {}'.format(args.output))
+
+    for failure in failures:
+        print('[!] {}'.format(failure))
+    if failures:
+        sys.exit(1)
@@ -7,35 +7,728 @@ __version__ = "0.1"
 
 import re
 import os
+import io
 import sys
+import csv
+import copy
+import math
+import glob
+import time
 import yaml
 import json
-import mistune
+import gzip
+import pickle
+import sqlite3
+import hashlib
+import html
+import threading
+import atexit
+import cProfile
 import argparse
+import warnings
+import functools
+import itertools
 from datetime import datetime
-from bs4 import BeautifulSoup
-from attackcti import attack_client
-from requests.auth import HTTPBasicAuth
-from elasticsearch import Elasticsearch
-from openpyxl.styles import Color
-from openpyxl import Workbook, load_workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.formatting.rule import ColorScaleRule, DataBarRule, FormulaRule
+from urllib.parse import urlsplit, parse_qs, unquote
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-CONFIG = yaml.load(open('resources/config.yml', 'r'), Loader=yaml.Loader)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#use the libyaml bindings when PyYAML was built with them
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+#write_sheet sets the table columns itself
+warnings.filterwarnings('ignore', 'In write-only mode you must add table columns manually')
+
+
+def load_yaml(filepath):
+    """ returns the single document of a yaml file """
+    with open(filepath, 'r') as yaml_file:
+        return yaml.load(yaml_file, Loader=YamlLoader)
+
+
+def iter_yaml(filepath):
+    """ yields the documents of a multi document yaml file one at a time """
+    with open(filepath, 'r') as yaml_file:
+        for document in yaml.load_all(yaml_file, Loader=YamlLoader):
+            yield document
+
+
+def dump_yaml(documents, filepath):
+    """ streams documents into a multi document yaml file """
+    with open(filepath, 'w') as yaml_file:
+        yaml.dump_all(documents, yaml_file, Dumper=YamlDumper, sort_keys=False)
+
+
+class lazyConfig(dict):
+    """Settings of config.yml, read on first access instead of at import time"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.loaded = False
+
+    def load(self):
+        """ reads the config file once, returns the settings """
+        if not self.loaded:
+            self.update(load_yaml(self.path))
+            self.loaded = True
+        return self
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self.load(), key)
+
+    def get(self, key, default=None):
+        return dict.get(self.load(), key, default)
+
+
+#inline markup mistune renders inside table cells
+HTML_TAG = re.compile(r'<[^>]*>')
+
+CONFIG = lazyConfig('resources/config.yml')
+
+
+class stageMetrics:
+    """Records wall time, peak RSS and record counts of pipeline stages"""
+
+    def __init__(self):
+        self.enabled = False
+        self.pstats_path = None
+        self.stages = []
+        #exports run in threads, each thread nests its own stages
+        self.local = threading.local()
+
+    def enable(self, pstats_path=None):
+        """ starts recording stages, optionally dumping a cProfile of each top level stage """
+        self.enabled = True
+        self.pstats_path = pstats_path
+
+    def peak_rss(self):
+        """ returns the peak resident set size of the process in bytes """
+        if resource is None:
+            return None
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #linux reports kilobytes, macOS bytes
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    @contextmanager
+    def stage(self, name):
+        """ records a stage, the yielded dict can be updated with extra metrics """
+        depth = getattr(self.local, 'depth', 0)
+        record = {'stage': name, 'depth': depth, 'records': None}
+
+        #only one profiler can be active, so nested stages and export threads are not profiled
+        profiler = None
+        if self.pstats_path and depth == 0 and threading.current_thread() is threading.main_thread():
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        self.local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['peak_rss'] = self.peak_rss()
+            self.local.depth = depth
+
+            if profiler:
+                profiler.disable()
+                if not os.path.exists(self.pstats_path):
+                    os.makedirs(self.pstats_path)
+                record['pstats'] = os.path.join(self.pstats_path, '{}_{}.pstats'.format(len(self.stages), name))
+                profiler.dump_stats(record['pstats'])
+
+            self.stages.append(record)
+
+    def save(self, path):
+        """ writes the recorded stages as a json report """
+        report_dir = os.path.dirname(path)
+        if report_dir and not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+
+        with open(path, 'w') as report_file:
+            json.dump({
+                'version': __version__,
+                'date': datetime.now().isoformat(),
+                'argv': sys.argv,
+                'stages': self.stages}, report_file, indent=2)
+
+        print('[*] Saved run profile to {}'.format(path))
+
+
+metrics = stageMetrics()
+
+
+def instrumented(func):
+    """ records the metrics of a pipeline stage when instrumentation is enabled """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return func(*args, **kwargs)
+
+        with metrics.stage(func.__qualname__) as record:
+            result = func(*args, **kwargs)
+            if isinstance(result, (list, dict)):
+                record['records'] = len(result)
+        return result
+
+    return wrapper
+
+
+def field_attribute(key):
+    """ returns the attribute name of an OSSEM field name """
+    return re.sub('[^0-9a-z]+', '_', key.lower())
+
+
+class ossemRecord:
+    """Slotted record with dict style access through the OSSEM field names"""
+
+    __slots__ = ('extra',)
+    fields = ()
+    attributes = {}
+    interned = ()
+    nested = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.attributes = dict((key, field_attribute(key)) for key in cls.fields)
+
+    def __init__(self):
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """ builds a record from a parsed yaml or markdown dict """
+        record = cls()
+        for key, value in data.items():
+            record[key] = value
+        return record
+
+    @classmethod
+    def from_values(cls, *values):
+        """ builds a record from values given in field order """
+        record = cls()
+        for attribute, value in zip(cls.__slots__, values):
+            setattr(record, attribute, value)
+        return record
+
+    def __setitem__(self, key, value):
+        if key in self.nested and value is not None:
+            record_class = self.nested[key]
+            value = [record_class.from_dict(v) if isinstance(v, dict) else v for v in value]
+        elif key in self.interned and isinstance(value, str):
+            value = sys.intern(value)
+
+        attribute = self.attributes.get(key)
+        if attribute:
+            setattr(self, attribute, value)
+        else:
+            #fields outside the OSSEM model are kept, they are rare
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        attribute = self.attributes.get(key)
+        if attribute:
+            try:
+                return getattr(self, attribute)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (ossemRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key, attribute in self.attributes.items() if hasattr(self, attribute)]
+        if self.extra:
+            keys += list(self.extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        """ returns a plain dict, used for yaml, json and elastic exports """
+        result = {}
+        for key, value in self.items():
+            if key in self.nested and value is not None:
+                value = [v.to_dict() if isinstance(v, ossemRecord) else v for v in value]
+            result[key] = value
+        return result
+
+
+def record_to_dict(entry):
+    """ returns a plain dict of a record, dicts are returned as they are """
+    return entry.to_dict() if isinstance(entry, ossemRecord) else entry
+
+
+def natural_keys(entries, key_fields, optional_fields=()):
+    """ yields (key, entry), keys join the key fields and the optional fields that are set """
+    seen = {}
+    for entry in entries:
+        values = [str(entry.get(field)) for field in key_fields]
+        values += [str(entry.get(field)) for field in optional_fields if entry.get(field)]
+        key = '|'.join(values)
+
+        #repeated keys get a counter, so duplicates keep their own key
+        occurrence = seen.get(key, 0)
+        seen[key] = occurrence + 1
+        if occurrence:
+            key = '{}#{}'.format(key, occurrence)
+
+        yield key, entry
+
+
+class dataField(ossemRecord):
+    """Field of a data dictionary or CIM entity"""
+
+    fields = ('standard name', 'field name', 'type', 'description', 'sample value')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+    interned = ('standard name', 'type')
+
+
+class dataDictionary(ossemRecord):
+    """Data dictionary of an event"""
+
+    fields = ('operating system', 'data channel', 'description', 'event', 'data fields')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+    interned = ('operating system', 'data channel')
+    nested = {'data fields': dataField}
+
+
+class cimEntity(ossemRecord):
+    """Common information model entity"""
+
+    fields = ('entity', 'description', 'data fields')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+    interned = ('entity',)
+    nested = {'data fields': dataField}
+
+
+class ddmRow(ossemRecord):
+    """Detection data model relationship and its data quality scores"""
+
+    fields = (
+        'att&ck data source',
+        'sub data source',
+        'source data object',
+        'relationship',
+        'destination data object',
+        'eventid',
+        'coverage',
+        'timeliness',
+        'retention',
+        'structure',
+        'consistency',
+        'score',
+        'data channel',
+        'comment',
+        'operating system')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+    interned = ('att&ck data source', 'source data object', 'relationship',
+        'destination data object', 'data channel', 'operating system')
+
+
+class cimEntry(ossemRecord):
+    """Flattened CIM field"""
+
+    fields = ('entity', 'standard name', 'type', 'description', 'sample value', 'relevant')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+
+
+class ddEntry(ossemRecord):
+    """Flattened data dictionary field"""
+
+    fields = ('data channel', 'operating system', 'event', 'standard name',
+        'field name', 'type', 'description', 'sample value')
+    __slots__ = tuple(field_attribute(key) for key in fields)
+
+
+class scoreMatrix:
+    """Columnar rows x dimensions store for data quality scores"""
+
+    dimensions = ('coverage', 'timeliness', 'retention', 'structure', 'consistency')
+
+    def __init__(self, width=len(dimensions)):
+        self.keys = []
+        self.index = {}
+        self.columns = [[] for i in range(width)]
+
+    @classmethod
+    def from_scores(cls, scores):
+        """ builds a matrix from a dict of key -> score list """
+        matrix = cls(width=len(cls.dimensions) + 1)
+        for key, row in scores.items():
+            matrix.append(key, row)
+        return matrix
+
+    def append(self, key, row):
+        """ appends a row, keeping the position of the first row of each key """
+        self.index.setdefault(key, len(self.keys))
+        self.keys.append(key)
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+    def gather(self, keys):
+        """ returns the column averages of the given keys, unknown keys count as zero """
+        rows = [self.index.get(key) for key in keys]
+        if not rows:
+            return [0 for column in self.columns]
+
+        return [sum(column[i] for i in rows if i is not None) / len(rows)
+                for column in self.columns]
+
+
+def split_data_sources(value):
+    """ returns the lowercase data sources of a ddm value, which may list several separated by commas """
+    #non covered data sources are skipped, to avoid polluting the average
+    if not value:
+        return []
+    return [ds.strip().lower() for ds in str(value).split(',') if ds.strip()]
+
+
+class scoreAggregator:
+    """Single pass grouped mean, min, max and standard deviation of data quality scores"""
+
+    dimensions = scoreMatrix.dimensions
+
+    def __init__(self, weights=None):
+        #dimension weights of the overall score, missing dimensions weigh 1
+        weights = weights or {}
+        self.weights = [weights.get(dimension, 1) for dimension in self.dimensions]
+        self.groups = {}
+
+    def add(self, key, row):
+        """ adds a row of dimension scores to the running totals of a group """
+        group = self.groups.get(key)
+        if group is None:
+            #count, sums, sums of squares, minimums, maximums
+            group = self.groups[key] = [0, [0] * len(row), [0] * len(row), list(row), list(row)]
+
+        group[0] += 1
+        sums, squares, minimums, maximums = group[1:]
+        for i, value in enumerate(row):
+            sums[i] += value
+            squares[i] += value * value
+            if value < minimums[i]:
+                minimums[i] = value
+            elif value > maximums[i]:
+                maximums[i] = value
+
+    def score(self, means):
+        """ returns the weighted average of the dimension means """
+        return sum(w * m for w, m in zip(self.weights, means)) / sum(self.weights)
+
+    def means(self):
+        """ returns the average of every dimension by group, plus the overall score """
+        result = {}
+        for key, (count, sums, squares, minimums, maximums) in self.groups.items():
+            avg = [total / count for total in sums]
+            avg.append(self.score(avg))
+            result[key] = avg
+        return result
+
+    def stats(self):
+        """ returns rows, mean, min, max and population standard deviation of every dimension by group """
+        result = {}
+        for key, (count, sums, squares, minimums, maximums) in self.groups.items():
+            stats = {'rows': count}
+            means = []
+            for i, dimension in enumerate(self.dimensions):
+                mean = sums[i] / count
+                means.append(mean)
+                stats[dimension] = {
+                    'mean': mean,
+                    'min': minimums[i],
+                    'max': maximums[i],
+                    'stddev': math.sqrt(max(0, squares[i] / count - mean * mean))}
+            stats['score'] = self.score(means)
+            result[key] = stats
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def get_parquet_schemas():
+    """ returns the arrow schemas of the snapshot tables, pyarrow is only imported for snapshots """
+    import pyarrow as pa
+
+    def schema(record_class, types):
+        columns = [(key, types.get(key, pa.string())) for key in record_class.fields if key not in record_class.nested]
+        if record_class.nested:
+            columns.append(('field count', pa.int64()))
+        return pa.schema(columns)
+
+    scores = dict((dimension, pa.int64()) for dimension in scoreMatrix.dimensions)
+    scores['score'] = pa.float64()
+
+    return {
+        'ddm': schema(ddmRow, scores),
+        'cim': schema(cimEntry, {'relevant': pa.bool_()}),
+        'dds': schema(ddEntry, {}),
+        'cim_entities': schema(cimEntity, {}),
+        'data_dictionaries': schema(dataDictionary, {})}
+
+
+def write_parquet(rows, schema, filepath):
+    """ writes records or dicts as a parquet table, text columns are stored as strings """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = [[] for field in schema]
+    for row in rows:
+        for column, field in zip(columns, schema):
+            column.append(row.get(field.name))
+
+    arrays = []
+    for column, field in zip(columns, schema):
+        if field.type == pa.string():
+            column = [v if v is None or isinstance(v, str) else str(v) for v in column]
+        arrays.append(pa.array(column, type=field.type))
+
+    pq.write_table(pa.Table.from_arrays(arrays, schema=schema), filepath)
+    return len(columns[0]) if columns else 0
+
+
+def read_parquet(filepath, schema):
+    """ returns the rows of a parquet table as tuples in schema order """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(filepath, columns=schema.names, memory_map=True)
+    return list(zip(*(column.to_pylist() for column in table.columns)))
+
+
+@contextmanager
+def open_ndjson(path, mode='r', compression=None):
+    """ opens an ndjson file, or stdin/stdout for '-', compressed by extension or explicitly """
+    if compression is None and path.endswith('.gz'):
+        compression = 'gzip'
+    elif compression is None and path.endswith('.zst'):
+        compression = 'zstd'
+
+    std = path == '-'
+    if std:
+        #prints are sent to stderr while stdout carries records, see __main__
+        raw = sys.stdin.buffer if mode == 'r' else sys.__stdout__.buffer
+    else:
+        raw = open(path, mode + 'b')
+
+    stream = raw
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode=mode + 'b')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            if not std:
+                raw.close()
+            raise ImportError('zstd compression needs the zstandard package')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        yield text
+    finally:
+        if mode != 'r':
+            text.flush()
+        text.detach()
+        if stream is not raw:
+            stream.close()
+        if std:
+            if mode != 'r':
+                raw.flush()
+        else:
+            raw.close()
+
+
+@functools.lru_cache(maxsize=8)
+def read_layer_template(path, mtime):
+    """ returns a parsed navigator layer template, cached until the file changes """
+    return load_yaml(path)
 
 
 class attackCTI:
     """This class performs all ATT&CK parsing related tasks"""
 
-    def __init__(self, ds_scores):
-        """Pull ATT&CK data from MITRE API"""
+    #bumped when the compact technique format changes, older caches are pulled again
+    cache_format = 2
+
+    #navigator domain of the layers of each ATT&CK matrix
+    layer_domains = {
+        'enterprise': 'mitre-enterprise',
+        'mobile': 'mitre-mobile',
+        'ics': 'ics-attack'}
+
+    def __init__(self, ds_scores, bundle=None, refresh=False):
+        """Load ATT&CK data from a local bundle, the local cache or MITRE API"""
+        if bundle:
+            print('[*] Loading ATT&CK bundle {}'.format(bundle))
+            self.techniques = self.load_bundle(bundle)
+        else:
+            self.techniques = self.load_cached(
+                CONFIG['ATTACK_CACHE'], CONFIG['ATTACK_CACHE_TTL'], refresh)
+
+        self.set_ds_scores(ds_scores)
+
+    def fetch(self):
+        """ pulls enterprise and mobile techniques from MITRE API, ICS is only read from bundles """
         print('[*] Pulling ATT&CK data')
 
+        #attackcti connects to the TAXII server on import
+        from attackcti import attack_client
+
         cli = attack_client()
-        attack = cli.get_enterprise(stix_format=False)
-        self.techniques = cli.remove_revoked(attack['techniques'])
+        enterprise = cli.get_enterprise(stix_format=False)
+        mobile = cli.get_mobile(stix_format=False)
+        return (self.compact(cli.remove_revoked(enterprise['techniques']), 'enterprise') +
+            self.compact(cli.remove_revoked(mobile['techniques']), 'mobile'))
+
+    def compact(self, techniques, domain):
+        """ keeps only the technique fields used to score and filter layers """
+        result = []
+        for t in techniques:
+            technique = {
+                'technique_id': t['technique_id'],
+                'technique': t.get('technique'),
+                'platform': t.get('platform', []),
+                'tactic': t.get('tactic', []),
+                'domains': [domain]}
+            if 'data_sources' in t:
+                technique['data_sources'] = t['data_sources']
+            result.append(technique)
+
+        return result
+
+    def digest_stix(self, objects):
+        """ converts STIX attack-pattern objects to compact techniques """
+        techniques = []
+        for obj in objects:
+            if obj.get('type') != 'attack-pattern' or obj.get('revoked'):
+                continue
+
+            refs = [r for r in obj.get('external_references', []) if r.get('external_id')]
+            if not refs:
+                continue
+
+            #bundles without domains are enterprise, like the original ATT&CK bundles
+            domains = [d.replace('-attack', '') for d in obj.get('x_mitre_domains', ['enterprise-attack'])]
+
+            technique = {
+                'technique_id': refs[0]['external_id'],
+                'technique': obj.get('name'),
+                'platform': obj.get('x_mitre_platforms', []),
+                'tactic': [p['phase_name'] for p in obj.get('kill_chain_phases', [])],
+                'domains': domains}
+            if 'x_mitre_data_sources' in obj:
+                technique['data_sources'] = obj['x_mitre_data_sources']
+            techniques.append(technique)
+
+        return techniques
+
+    def read_cache(self, path):
+        """ returns a techniques cache, None if missing or written by another version """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except ValueError:
+            return None
+
+        if cache.get('version') != __version__ or cache.get('format') != self.cache_format:
+            return None
+        return cache
+
+    def write_cache(self, path, techniques):
+        """ stores compact techniques with their creation time """
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(path, 'w') as cache_file:
+            json.dump({
+                'version': __version__,
+                'format': self.cache_format,
+                'created': time.time(),
+                'techniques': techniques}, cache_file)
+
+    @instrumented
+    def load_bundle(self, path):
+        """ returns the techniques of a local STIX bundle, digested once next to it """
+        compact_path = path + '.techniques.json'
+        if os.path.exists(compact_path) and os.path.getmtime(compact_path) >= os.path.getmtime(path):
+            cache = self.read_cache(compact_path)
+            if cache:
+                return cache['techniques']
+
+        with open(path, 'r') as bundle_file:
+            bundle = json.load(bundle_file)
+
+        techniques = self.digest_stix(bundle.get('objects', []))
+        self.write_cache(compact_path, techniques)
+        return techniques
+
+    @instrumented
+    def load_cached(self, path, ttl, refresh=False):
+        """ returns cached techniques, pulling them again once older than ttl hours """
+        cache = self.read_cache(path)
+        if cache and not refresh and time.time() - cache['created'] < ttl * 3600:
+            print('[*] Loading ATT&CK data from {}'.format(path))
+            return cache['techniques']
+
+        try:
+            techniques = self.fetch()
+        except Exception as e:
+            #offline hosts keep working with whatever was cached last
+            if cache:
+                print('[!] Could not pull ATT&CK data ({}), using cache {}'.format(e, path))
+                return cache['techniques']
+            raise
+
+        self.write_cache(path, techniques)
+        return techniques
+
+    def set_ds_scores(self, ds_scores):
+        """ replaces the data source scores used to score techniques """
         self.ds_scores = ds_scores
+        self.ds_matrix = scoreMatrix.from_scores(ds_scores)
+        self.score_cache = {}
 
     def to_score(self, number):
         return float(('{0:.2f}'.format(number)))
@@ -43,135 +736,431 @@ class attackCTI:
     def get_techniques(self):
         return self.techniques
 
-    def data_source_score(self, data_source):
-        #ds_scores = self.ds_scores
-        if data_source.lower() in self.ds_scores:
-            return self.ds_scores[data_source.lower()]
-        else:
-            return [0,0,0,0,0,0,0]
-
     def get_ds_score(self, data_sources):
         """Retrieves average score of all techniques"""
+        #many techniques share the same data sources, so scores are kept per data source tuple
+        key = tuple(ds.lower() for ds in data_sources)
+        if key not in self.score_cache:
+            #calculate average of scores
+            scores = self.ds_matrix.gather(key)
+            self.score_cache[key] = [self.to_score(v) for v in scores]
+
+        return list(self.score_cache[key])
+
+    def get_layer_template(self, path='resources/navigator_layer.yml'):
+        """ returns a copy of the navigator layer template """
+        return copy.deepcopy(read_layer_template(path, os.stat(path).st_mtime_ns))
+
+    def get_layer_technique(self, t):
+        """ returns the navigator layer entry of a technique """
+        comment = ""
+        if 'data_sources' in t:
+            scores = self.get_ds_score(t['data_sources'])
+            dq_coverage = scores[0]
+            dq_timeliness = scores[1]
+            dq_retention = scores[2]
+            dq_structure = scores[3]
+            dq_consistency = scores[4]
+            dq_score = scores[5]
+        else:
+            comment = 'technique has no data sources'
+            dq_coverage = 0
+            dq_timeliness = 0
+            dq_retention = 0
+            dq_structure = 0
+            dq_consistency = 0
+            dq_score = 0
+
+        return {
+            "techniqueID": t['technique_id'],
+            "score": dq_score,
+            "comment": comment,
+            "enabled": True,
+            "metadata": [
+                {"name": "coverage", "value": str(dq_coverage)},
+                {"name": "timeliness", "value": str(dq_timeliness)},
+                {"name": "retention", "value": str(dq_retention)},
+                {"name": "structure", "value": str(dq_structure)},
+                {"name": "consistency", "value": str(dq_consistency)}]}
+
+    @instrumented
+    def get_ds_quality_layers(self, domains=('enterprise',), platforms=False):
+        """ returns {(domain, platform): layer} for every domain, and every platform when asked, in one pass """
+        entries = {}
+        for t in self.get_techniques():
+            technique = None
+            #caches written before domains were kept only hold enterprise techniques
+            for domain in t.get('domains', ['enterprise']):
+                if domain not in domains:
+                    continue
+                if technique is None:
+                    technique = self.get_layer_technique(t)
+
+                entries.setdefault((domain, None), []).append(technique)
+                if platforms:
+                    for platform in t.get('platform', []):
+                        entries.setdefault((domain, platform), []).append(technique)
+
+        return dict((key, self.get_domain_layer(key[0], key[1], techniques))
+            for key, techniques in entries.items())
+
+    def get_domain_layer(self, domain, platform, techniques):
+        """ returns the navigator layer of a matrix, or of one platform of it """
+        layer = self.get_layer_template()
+        layer['name'] = 'Data Quality'
+        layer['description'] = 'Data source quality according OSSEM data model'
+        layer['domain'] = self.layer_domains.get(domain, domain)
+
+        #the template filters fit enterprise, other matrices list their own platforms
+        if platform:
+            layer['name'] = 'Data Quality {}'.format(platform)
+            layer['filters']['platforms'] = [platform]
+        elif domain != 'enterprise':
+            layer['filters']['platforms'] = sorted(set(p for t in self.get_techniques()
+                if domain in t.get('domains', ['enterprise']) for p in t.get('platform', [])))
+        if domain != 'enterprise':
+            layer['name'] = '{} ({})'.format(layer['name'], domain)
+
+        #ics-attack is only known to navigator 4, whose layer format has versions and no stages filter
+        if domain == 'ics':
+            del layer['version']
+            layer['versions'] = {'layer': '4.0'}
+            layer['filters'].pop('stages', None)
+
+        layer['techniques'] = techniques
+        return layer
+
+    @instrumented
+    def get_ds_quality_layer(self, domain='enterprise', platform=None):
+        """ returns an attack data source quality navigator layer """
+        print('[*] Generating data source quality layer')
 
-        score_list = []
-        for ds in data_sources:
-            score_list.append(self.data_source_score(ds))
+        layers = self.get_ds_quality_layers(domains=(domain,), platforms=platform is not None)
+        self.nav_layer = layers.get((domain, platform))
+        if self.nav_layer is None:
+            self.nav_layer = self.get_domain_layer(domain, platform, [])
+        return self.nav_layer
 
-        #calculate average of scores
-        score = [self.to_score(sum(v) / len(v)) for v in zip(*score_list)]
-        return score
 
-    def get_ds_quality_layer(self):
-        """ returns an attack data source quality navigator layer """
-        print('[*] Generating data source quality layer')
+@functools.lru_cache(maxsize=None)
+def get_md_renderer():
+    """ returns the markdown renderer class, mistune is only imported when markdown is parsed """
+    import mistune
 
-        self.nav_layer = yaml.load(open('resources/navigator_layer.yml', 'r'), Loader=yaml.Loader)
-        self.nav_layer['name'] = 'Data Quality'
-        self.nav_layer['description'] = 'Data source quality according OSSEM data model'
+    class mdRenderer(mistune.Renderer):
+        def __init__(self, renderer=None, inline=None, block=None, **kwargs):
+            super().__init__(**kwargs)
+            self.is_data_field = False
+            self.is_description = False
+            self.data_fields = []
+            self.description = None
+            self.table_cells = []
+            self.table_rows = []
+            self.context = kwargs.get('context')
+
+        def get_description(self):
+            """ returns object description """
+            return self.description
+
+        def get_data_fields(self):
+            """ returns a common information model entity """
+            return self.data_fields
+
+        def table_cell(self, content, **flags):
+            """ collects the plain text of a table cell instead of rendering it """
+            self.table_cells.append(html.unescape(HTML_TAG.sub('', content)))
+            return ''
+
+        def table_row(self, content):
+            """ collects the cells of a table row """
+            self.table_rows.append(self.table_cells)
+            self.table_cells = []
+            return ''
+
+        def header(self, text, level, raw=None):
+            """ returns the header markdown entries """
+            if text == 'Data Fields' or text == 'Data Dictionary':
+                self.is_data_field = True
+            elif level == 1 and self.context == 'cim':
+                self.is_description = True
+            elif text == 'Description':
+                self.is_description = True
+            return text
+
+        def table(self, header, body):
+            """ returns table markdown entries """
+            #the header row is always collected first
+            if self.is_data_field or self.context == 'ddm':
+                headers = [i.lower() for i in self.table_rows[0]]
+                self.data_fields = [dict(zip(headers, row)) for row in self.table_rows[1:]]
+                self.is_data_field = False
+
+            self.table_rows = []
+            return header
+
+        def paragraph(self, text):
+            """ returns paragraphs """
+            if self.is_description:
+                self.description = text
+                self.is_description = False
+            return text
+
+    return mdRenderer
+
+
+def parse_markdown_file(filepath, context):
+    """ renders a single OSSEM markdown file, returns its description, data fields and parse time """
+    start = time.perf_counter()
+    import mistune
+    renderer = get_md_renderer()(context=context)
+    md = mistune.Markdown(renderer=renderer)
+    with open(filepath, 'r') as md_file:
+        md(md_file.read())
+
+    return (md.renderer.get_description(),
+            md.renderer.get_data_fields(),
+            time.perf_counter() - start)
+
+
+class parseCache:
+    """On-disk cache of parsed OSSEM files keyed by path, mtime and content hash"""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.entries = {}
+        self.dirty = False
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as cache_file:
+                    cache = pickle.load(cache_file)
+                #results of a different sourcerer version may not parse the same
+                if cache.get('version') == __version__:
+                    self.entries = cache['entries']
+            except Exception:
+                print('[!] Ignoring unreadable cache {}'.format(path))
+
+    def file_hash(self, filepath):
+        """ returns the sha1 of a file content """
+        with open(filepath, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def get(self, filepath):
+        """ returns the cached parse result of a file, None if missing or changed """
+        entry = self.entries.get(filepath)
+        if entry is None:
+            return None
+
+        mtime = os.stat(filepath).st_mtime_ns
+        if entry['mtime'] != mtime:
+            #touched but possibly unchanged, fall back to the content hash
+            if entry['hash'] != self.file_hash(filepath):
+                return None
+            entry['mtime'] = mtime
+            self.dirty = True
+
+        entry['used'] = time.time()
+        return pickle.loads(entry['data'])
+
+    def put(self, filepath, result):
+        """ stores the parse result of a file """
+        self.entries[filepath] = {
+            'mtime': os.stat(filepath).st_mtime_ns,
+            'hash': self.file_hash(filepath),
+            'used': time.time(),
+            'data': pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)}
+        self.dirty = True
+
+    def evict(self):
+        """ drops entries of deleted files, then least recently used ones above max size """
+        for filepath in [f for f in self.entries if not os.path.exists(f)]:
+            del self.entries[filepath]
+            self.dirty = True
+
+        size = sum(len(entry['data']) for entry in self.entries.values())
+        for filepath in sorted(self.entries, key=lambda f: self.entries[f]['used']):
+            if size <= self.max_size:
+                break
+            size -= len(self.entries.pop(filepath)['data'])
+            self.dirty = True
+
+    def save(self):
+        """ writes the cache to disk if it changed """
+        self.evict()
+        if not self.dirty:
+            return False
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump({'version': __version__, 'entries': self.entries},
+                cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        return True
 
-        for t in self.get_techniques():
-            comment = ""
-            if 'data_sources' in t:
-                scores = self.get_ds_score(t['data_sources'])
-                dq_coverage = scores[0]
-                dq_timeliness = scores[1]
-                dq_retention = scores[2]
-                dq_structure = scores[3]
-                dq_consistency = scores[4]
-                dq_score = scores[5]
-            else:
-                comment = 'technique has no data sources'
-                dq_coverage = 0
-                dq_timeliness = 0
-                dq_retention = 0
-                dq_structure = 0
-                dq_consistency = 0
-                dq_score = 0
 
-            technique = {
-                "techniqueID": t['technique_id'],
-                "score": dq_score,
-                "comment": comment,
-                "enabled": True,
-                "metadata": [
-                    {"name": "coverage", "value": str(dq_coverage)},
-                    {"name": "timeliness", "value": str(dq_timeliness)},
-                    {"name": "retention", "value": str(dq_retention)},
-                    {"name": "structure", "value": str(dq_structure)},
-                    {"name": "consistency", "value": str(dq_consistency)}]}
-
-            self.nav_layer['techniques'].append(technique)
+#parsed corpus shared by the processes scoring profiles
+profile_worker_parser = None
 
-        return self.nav_layer
 
+def init_profile_worker(ossem):
+    """ keeps the parsed corpus in the worker process """
+    global profile_worker_parser
+    profile_worker_parser = ossem
 
-class mdRenderer(mistune.Renderer):
-    def __init__(self, renderer=None, inline=None, block=None, **kwargs):
-        super().__init__(**kwargs)
-        self.is_data_field = False
-        self.is_description = False
-        self.data_fields = []
-        self.description = None
-        self.context = kwargs.get('context')
 
-    def get_description(self):
-        """ returns object description """
-        return self.description
+def enrich_profile(profile):
+    """ returns the shared ddm enriched against a profile """
+    return profile_worker_parser.with_profile(profile).enrich_ddm()
 
-    def get_data_fields(self):
-        """ returns a common information model entity """
-        return self.data_fields
 
-    def table_to_dict(self, header, rows):
-        """ takes the header and rows list and returns a list of dictionaries"""
-        table = []
-        headers = [i.text.lower() for i in header]
-        for row in rows:
-            columns = [i.text for i in row.find_all('td')]
-            table.append(dict(zip(headers, columns)))
-
-        return table
-
-    def header(self, text, level, raw=None):
-        """ returns the header markdown entries """
-        if text == 'Data Fields' or text == 'Data Dictionary':
-            self.is_data_field = True
-        elif level == 1 and self.context == 'cim':
-            self.is_description = True
-        elif text == 'Description':
-            self.is_description = True
-        return text
-
-    def table(self, header, body):
-        """ returns table markdown entries """
-        if self.is_data_field or self.context == 'ddm':
-            header_list = BeautifulSoup(header, 'lxml').find_all('th')
-            row_list = BeautifulSoup(body, 'lxml').find_all('tr')
-            self.data_fields = self.table_to_dict(header_list, row_list)
-            self.is_data_field = False
+def get_profile_paths(path):
+    """ returns the profile yaml files of a directory or glob pattern """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.yml')
+    return sorted(glob.glob(path))
 
-        return header
 
-    def paragraph(self, text):
-        """ returns paragraphs """
-        if self.is_description:
-            self.description = text
-            self.is_description = False
-        return text
+def get_profile_names(paths):
+    """ returns a unique name per profile path, the file name unless several profiles share it """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len(set(names)) == len(names):
+        return names
+
+    #profiles with the same file name are told apart by their path below the common directory
+    paths = [os.path.abspath(path) for path in paths]
+    common = os.path.commonpath(paths)
+    return [os.path.splitext(os.path.relpath(path, common))[0].replace(os.sep, '/') for path in paths]
+
+
+def export_profile_comparison(parsers, path):
+    """ writes a csv with the data source score of every profile """
+    scores = dict((name, parser.get_ds_scores()) for name, parser in parsers.items())
+    data_sources = sorted(set(ds for ds_scores in scores.values() for ds in ds_scores))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    dt = datetime.now().strftime("%Y%m%d_%H%M%S")
+    with open('{}profiles_{}.csv'.format(path, dt), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['ATT&CK Data Source'] + list(scores.keys()))
+        for ds in data_sources:
+            writer.writerow([ds] + [
+                round(ds_scores[ds][-1], 2) if ds in ds_scores else ''
+                for ds_scores in scores.values()])
+
+    print('[*] Created {}profiles_{}.csv'.format(path, dt))
+
+
+def get_exports(ossem, path, args, attack=None, profile=None):
+    """ returns the (name, function) exports selected on the command line for an enriched parser """
+    exports = []
+    if args.excel:
+        exports.append(('Excel', functools.partial(ossem.export_to_xlsx, path, extra_sheets=args.excel_all)))
+    if args.elastic:
+        exports.append(('Elastic', functools.partial(ossem.export_to_elastic, rebuild=args.elastic_rebuild)))
+    if args.yaml:
+        exports.append(('YAML', functools.partial(ossem.export_to_yaml, path)))
+    if args.parquet:
+        exports.append(('Parquet', functools.partial(ossem.export_to_parquet, path)))
+    if args.ndjson:
+        #each profile writes the file name into its own directory
+        ndjson_path = args.ndjson if args.ndjson == '-' or not args.profiles else path + os.path.basename(args.ndjson)
+        exports.append(('NDJSON', functools.partial(ossem.export_to_ndjson, ndjson_path, args.ndjson_compression)))
+    if args.layer:
+        exports.append(('ATT&CK Navigator Layer', functools.partial(ossem.export_to_layer, path, attack=attack,
+            domains=args.layer_domains, platforms=args.layer_platforms)))
+    if args.store:
+        def store():
+            snapshot = snapshotStore(CONFIG['SNAPSHOT_DB']).save(ossem, attack, profile=profile)
+            print('[*] Saved snapshot {} of {}'.format(snapshot, profile))
+        exports.append(('snapshot database', store))
+
+    return exports
+
+
+class lineWriter:
+    """Stream wrapper writing whole lines only, so status lines of export threads don't interleave"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def write(self, text):
+        lines, newline, rest = (getattr(self.local, 'pending', '') + text).rpartition('\n')
+        self.local.pending = rest
+        if newline:
+            with self.lock:
+                self.stream.write(lines + newline)
+        return len(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_exports(exports, workers):
+    """ runs independent exports of the shared model in a thread pool, returns the names of failed exports """
+    failed = []
+
+    def run(name, export):
+        try:
+            export()
+        except Exception as e:
+            print('[!] {} export failed: {}'.format(name, e))
+            failed.append(name)
+
+    #a single worker exports on the calling thread, where the stages can be profiled
+    if workers <= 1:
+        for name, export in exports:
+            print('[*] Exporting OSSEM to {}'.format(name))
+            run(name, export)
+        return failed
+
+    stdout = sys.stdout
+    sys.stdout = lineWriter(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, export in exports:
+                print('[*] Exporting OSSEM to {}'.format(name))
+                pool.submit(run, name, export)
+    finally:
+        sys.stdout = stdout
+
+    return failed
+
 
 class ossemParser():
-    def __init__(self, profile):
-        self.profile = yaml.load(open(profile, 'r'), Loader=yaml.Loader)
-        self.data_channels = list(yaml.load_all(open('resources/dcs.yml', 'r'), Loader=yaml.Loader))
+    def __init__(self, profile, cache=None):
+        self.profile = load_yaml(profile) if isinstance(profile, str) else profile
+        self.data_channels = list(iter_yaml('resources/dcs.yml'))
         self.cim_entities = []
         self.cim_ignore = ['domain_or_hostname_or_fqdn.md']
         self.data_dictionaries = []
         self.data_dictionaries_ignore = []
         self.ddm_list = []
         self.ddm_ignore = ['object_relationships.md']
-
-    def parse_markdown(self, path):
+        self.parse_timings = []
+        self.cache = cache
+        self.platform = None
+        self.dd_index = {}
+        self.dd_platforms = {}
+        self.dd_keys = {}
+        self.dd_fields = {}
+        self.dcs_index = {}
+        self.cim_index = {}
+        self.reset_enrichment()
+
+    @instrumented
+    def parse_markdown(self, path, workers=1):
         """ parser for ossem in markdown """
+        files_to_parse = []
         for root, dirs, files in os.walk(path):
             for name in files:
                 filepath = root + os.sep + name
@@ -183,55 +1172,434 @@ class ossemParser():
 
                     #parse cim
                     if cim in path and name not in self.cim_ignore:
-                        renderer = mdRenderer(context='cim')
-                        md = mistune.Markdown(renderer=renderer)
-                        with open(filepath, 'r') as md_file:
-                            md(md_file.read())
-                            self.cim_entities.append({
-                                'entity': name.split('.')[0],
-                                'description': md.renderer.get_description(),
-                                'data fields': md.renderer.get_data_fields()})
+                        files_to_parse.append((filepath, 'cim', {
+                            'entity': name.split('.')[0]}))
 
                     #parse dd
                     elif dd in path and name not in self.data_dictionaries_ignore:
                         dd_path = path[path.index(dd)+1:]
-                        os_name = dd_path[0]
-                        data_channel = dd_path[1]
-                        renderer = mdRenderer(context='dd')
-                        md = mistune.Markdown(renderer=renderer)
-                        with open(filepath, 'r') as md_file:
-                            md(md_file.read())
-                            self.data_dictionaries.append({
-                                'operating system': os_name,
-                                'data channel': data_channel,
-                                'description': md.renderer.get_description(),
-                                'event': re.sub('event-', '', name.split('.')[0]),
-                                'data fields': md.renderer.get_data_fields()})
+                        files_to_parse.append((filepath, 'dd', {
+                            'operating system': dd_path[0],
+                            'data channel': dd_path[1],
+                            'event': re.sub('event-', '', name.split('.')[0])}))
 
                     #parse ddm
                     elif ddm in path and name not in self.ddm_ignore:
-                        renderer = mdRenderer(context='ddm')
-                        md = mistune.Markdown(renderer=renderer)
-                        with open(filepath, 'r') as md_file:
-                            md(md_file.read())
-                            self.ddm_list += md.renderer.get_data_fields()
-
+                        files_to_parse.append((filepath, 'ddm', {}))
+
+        results = [None] * len(files_to_parse)
+        if self.cache:
+            #cached files are not parsed this run, so they take no parse time
+            results = [self.cache.get(f[0]) for f in files_to_parse]
+            results = [result and (result[0], result[1], 0.0) for result in results]
+
+        #only files missing from the cache are parsed again
+        misses = [i for i, result in enumerate(results) if result is None]
+        filepaths = [files_to_parse[i][0] for i in misses]
+        contexts = [files_to_parse[i][1] for i in misses]
+
+        #results come back in submission order, so the merge matches a serial run
+        if workers > 1 and len(misses) > 1:
+            chunksize = max(1, len(filepaths) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed = pool.map(parse_markdown_file, filepaths, contexts, chunksize=chunksize)
+                parsed = list(parsed)
+        else:
+            parsed = map(parse_markdown_file, filepaths, contexts)
+
+        for i, result in zip(misses, parsed):
+            results[i] = result
+            if self.cache:
+                self.cache.put(files_to_parse[i][0], result[:2])
+
+        for (filepath, context, meta), (description, data_fields, elapsed) in zip(files_to_parse, results):
+            self.parse_timings.append((filepath, elapsed))
+
+            if context == 'cim':
+                self.cim_entities.append(cimEntity.from_dict({
+                    'entity': meta['entity'],
+                    'description': description,
+                    'data fields': data_fields}))
+
+            elif context == 'dd':
+                self.data_dictionaries.append(dataDictionary.from_dict({
+                    'operating system': meta['operating system'],
+                    'data channel': meta['data channel'],
+                    'description': description,
+                    'event': meta['event'],
+                    'data fields': data_fields}))
+
+            elif context == 'ddm':
+                self.ddm_list += [ddmRow.from_dict(row) for row in data_fields]
+
+        self.build_indexes()
         return self.ddm_list
 
+    def get_parse_timings(self, limit=None):
+        """ returns (file, seconds) parse timings, slowest first """
+        timings = sorted(self.parse_timings, key=lambda t: t[1], reverse=True)
+        return timings[:limit] if limit else timings
+
+    @instrumented
     def parse_yaml(self, path):
         """ parser for ossem in yaml """
-        self.ddm_list = list(yaml.load_all(open(path+CONFIG['OSSEM_YAML_DDM'], 'r'), Loader=yaml.Loader))
-        self.data_dictionaries = list(yaml.load_all(open(path+CONFIG['OSSEM_YAML_DDS'], 'r'), Loader=yaml.Loader))
-        self.cim_entities = list(yaml.load_all(open(path+CONFIG['OSSEM_YAML_CIM'], 'r'), Loader=yaml.Loader))
+        self.ddm_list = [ddmRow.from_dict(d)
+            for d in self.iter_yaml_file(path+CONFIG['OSSEM_YAML_DDM'])]
+        self.data_dictionaries = [dataDictionary.from_dict(d)
+            for d in self.iter_yaml_file(path+CONFIG['OSSEM_YAML_DDS'])]
+        self.cim_entities = [cimEntity.from_dict(d)
+            for d in self.iter_yaml_file(path+CONFIG['OSSEM_YAML_CIM'])]
+
+        self.build_indexes()
+        return self.ddm_list
+
+    def parse_parquet(self, path):
+        """ loads a snapshot written by export_to_parquet instead of parsing OSSEM """
+        schemas = get_parquet_schemas()
+
+        self.ddm_list = [ddmRow.from_values(*row)
+            for row in read_parquet(os.path.join(path, 'ddm.parquet'), schemas['ddm'])]
 
+        #only rows expanded per platform have an operating system
+        for row in self.ddm_list:
+            if row['operating system'] is None:
+                del row.operating_system
+
+        #fields are stored in dictionary order, each dictionary takes its field count
+        #and a missing description is stored as null, so it is dropped again
+        fields = iter(read_parquet(os.path.join(path, 'dds.parquet'), schemas['dds']))
+        self.data_dictionaries = []
+        for operating_system, data_channel, description, event, count in read_parquet(
+                os.path.join(path, 'data_dictionaries.parquet'), schemas['data_dictionaries']):
+            data_fields = [dataField.from_values(*next(fields)[3:]) for i in range(count)]
+            data = dataDictionary.from_values(
+                sys.intern(operating_system), sys.intern(data_channel), description, event, data_fields)
+            if description is None:
+                del data.description
+            self.data_dictionaries.append(data)
+
+        fields = iter(read_parquet(os.path.join(path, 'cim.parquet'), schemas['cim']))
+        self.cim_entities = []
+        for entity, description, count in read_parquet(
+                os.path.join(path, 'cim_entities.parquet'), schemas['cim_entities']):
+            data_fields = []
+            for i in range(count):
+                name, standard_name, field_type, field_description, sample_value, relevant = next(fields)
+                data_fields.append(dataField.from_dict({
+                    'standard name': standard_name,
+                    'type': field_type,
+                    'description': field_description,
+                    'sample value': sample_value}))
+            entity = cimEntity.from_values(sys.intern(entity), description, data_fields)
+            if description is None:
+                del entity.description
+            self.cim_entities.append(entity)
+
+        self.build_indexes()
         return self.ddm_list
 
-    def enrich_ddm(self):
-        """ iterate over ddm entries and calculate data quality scores """
+    def parse_ndjson(self, path, compression=None):
+        """ loads a stream written by export_to_ndjson, '-' reads stdin """
+        self.ddm_list = []
+        headers = {'cim_entity': [], 'data_dictionary': []}
+        fields = {'cim': [], 'dds': []}
+
+        with open_ndjson(path, 'r', compression) as ndjson_file:
+            for line in ndjson_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                kind = record.pop('record')
+                if kind == 'ddm':
+                    self.ddm_list.append(ddmRow.from_dict(record))
+                elif kind in headers:
+                    headers[kind].append(record)
+                elif kind in fields:
+                    fields[kind].append(record)
+
+        #fields follow their parents order, each parent takes its field count
+        dds = iter(fields['dds'])
+        self.data_dictionaries = []
+        for header in headers['data_dictionary']:
+            count = header.pop('field count')
+            header['data fields'] = [dict((key, field.get(key)) for key in dataField.fields)
+                for field in itertools.islice(dds, count)]
+            self.data_dictionaries.append(dataDictionary.from_dict(header))
+
+        cim = iter(fields['cim'])
+        self.cim_entities = []
+        for header in headers['cim_entity']:
+            count = header.pop('field count')
+            header['data fields'] = [dict((key, field[key]) for key in dataField.fields if key in field)
+                for field in itertools.islice(cim, count)]
+            self.cim_entities.append(cimEntity.from_dict(header))
 
+        self.build_indexes()
+        return self.ddm_list
+
+    def iter_yaml_file(self, filepath):
+        """ yields the documents of a yaml file, from cache when unchanged """
+        documents = self.cache.get(filepath) if self.cache else None
+        if documents is not None:
+            yield from documents
+            return
+
+        documents = []
+        for document in iter_yaml(filepath):
+            documents.append(document)
+            yield document
+
+        if self.cache:
+            self.cache.put(filepath, documents)
+
+    def with_profile(self, profile):
+        """ returns a parser sharing the parsed corpus and indexes, scored against another profile """
+        parser = copy.copy(self)
+        parser.update_profile(profile)
+        parser.cache = None
+        parser.ddm_list = [copy.copy(row) for row in self.ddm_list]
+
+        #intermediate results are replaced, never mutated, so copying the lists is enough
+        if self.row_channels is not None:
+            parser.row_channels = list(self.row_channels)
+            parser.row_structures = list(self.row_structures)
+        return parser
+
+    def update_profile(self, profile):
+        """ replaces the profile, the next enrichment only rescores rows of changed entities """
+        self.profile = load_yaml(profile) if isinstance(profile, str) else profile
+
+    def update_data_channels(self, path='resources/dcs.yml'):
+        """ reloads data channel scores, the next enrichment only rescores rows of changed channels """
+        self.data_channels = list(iter_yaml(path))
+        self.index_data_channels()
+
+    @instrumented
+    def score_profiles(self, profiles, workers=1):
+        """ enriches the ddm against every profile, returns a parser per profile name """
+        parsers = [self.with_profile(profile) for profile in profiles]
+
+        if workers > 1 and len(parsers) > 1:
+            shared = copy.copy(self)
+            shared.cache = None
+            with ProcessPoolExecutor(max_workers=workers,
+                    initializer=init_profile_worker, initargs=(shared,)) as pool:
+                for parser, ddm_list in zip(parsers, pool.map(enrich_profile, profiles)):
+                    parser.ddm_list = ddm_list
+        else:
+            for parser in parsers:
+                parser.enrich_ddm()
+
+        return dict(zip(get_profile_names(profiles), parsers))
+
+    @instrumented
+    def build_indexes(self):
+        """ precompute lookup tables used when enriching the ddm """
+        self.dd_index = {}
+        self.dd_platforms = {}
+        self.dd_keys = {}
+        self.dd_fields = {}
+        self.dcs_index = {}
+        self.cim_index = {}
+
+        #dictionaries are listed in corpus order, the first one is used unless a platform narrows them
+        for dd in self.data_dictionaries:
+            key = self.dd_key(dd)
+            if key in self.dd_keys:
+                continue
+            self.dd_keys[key] = dd
+            self.dd_fields[key] = set(field['standard name'] for field in dd['data fields'])
+            self.dd_index.setdefault(dd['event'], []).append(dd)
+            self.dd_platforms.setdefault((dd['operating system'], dd['event']), []).append(dd)
+
+        self.index_data_channels()
+
+        for entity in self.cim_entities:
+            self.cim_index.setdefault(entity['entity'], entity)
+
+        self.reset_enrichment()
+
+    def dd_key(self, dd):
+        """ returns the (operating system, data channel, event) key of a data dictionary """
+        return (dd['operating system'], dd['data channel'], dd['event'])
+
+    def set_platform(self, platform):
+        """ only matches dictionaries of an operating system, None matches every platform """
+        self.platform = platform.lower() if platform else None
+        self.reset_enrichment()
+
+    def get_dictionaries(self, row):
+        """ returns the data dictionaries matching a ddm row, on its platform when one is known """
+        platform = row.get('operating system') or self.platform
+        if platform:
+            return self.dd_platforms.get((platform, row['eventid']), [])
+        return self.dd_index.get(row['eventid'], [])
+
+    def get_ambiguous_events(self):
+        """ returns the dictionary keys of ddm events matching several dictionaries, by platform and event """
+        ambiguous = {}
+        for row in self.ddm_list:
+            dds = self.get_dictionaries(row)
+            if len(dds) > 1:
+                platform = row.get('operating system') or self.platform
+                ambiguous[(platform, row['eventid'])] = [self.dd_key(dd) for dd in dds]
+        return ambiguous
+
+    def expand_platforms(self):
+        """ replaces every ddm row with one row per platform that has a dictionary for its event """
+        rows = []
         for row in self.ddm_list:
-            event_name = row['eventid']
+            platforms = []
+            for dd in self.get_dictionaries(row):
+                if dd['operating system'] not in platforms:
+                    platforms.append(dd['operating system'])
+
+            if not platforms:
+                rows.append(row)
+            for platform in platforms:
+                platform_row = copy.copy(row)
+                platform_row['operating system'] = platform
+                rows.append(platform_row)
+
+        self.ddm_list = rows
+        self.reset_enrichment()
+        return self.ddm_list
 
+    def index_data_channels(self):
+        """ precompute the data channel lookup table """
+        self.dcs_index = {}
+        for dcs in self.data_channels:
+            self.dcs_index.setdefault(dcs['data channel'], dcs)
+
+    def reset_enrichment(self):
+        """ drops intermediate enrichment results, the next enrichment scores every row """
+        self.consistency_scores = {}
+        self.row_channels = None
+        self.row_structures = None
+        self.enriched_dcs = None
+        self.enriched_profile = None
+
+    def get_dcs_snapshot(self):
+        """ returns the scores enrichment depends on, by data channel """
+        return dict((channel, (dcs['coverage'], dcs['timeliness'], dcs['retention']))
+            for channel, dcs in self.dcs_index.items())
+
+    def get_profile_snapshot(self):
+        """ returns the fields enrichment depends on, by entity """
+        return dict((entity, tuple(fields or []))
+            for entity, fields in self.profile.items())
+
+    def changed_keys(self, old, new):
+        """ returns keys added, removed or changed between two snapshots """
+        return set(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+    def get_channel_scores(self, dd):
+        """ returns coverage, timeliness, retention, data channel and comment of a dictionary channel """
+        dcs = self.dcs_index.get(dd['data channel'])
+
+        #retrieve data channels scores, otherwise set them to zero
+        if dcs:
+            return (int(dcs['coverage']), int(dcs['timeliness']), int(dcs['retention']),
+                dcs['data channel'], '')
+        return (0, 0, 0, None, 'data channel not found')
+
+    def get_structure_score(self, row, dd):
+        """ returns the structure score of a row and a comment when entities can't be scored """
+        matched_fields = 0
+        total_fields = 0
+        structure_score = 0
+        comment = None
+
+        entities = [
+            row['source data object'],
+            row['destination data object']]
+
+        invalid = False
+        missing = 0
+        for entity in entities:
+            match = self.cim_index.get(entity)
+
+            if invalid:
+                continue
+            elif not entity:
+                missing += 1
+                if missing == 2:
+                    comment = 'both entities are missing'
+                    invalid = True
+            elif match and not invalid and missing < 2:
+                if match['entity'] in self.profile:
+                    for field in self.profile[match['entity']]:
+                        total_fields += 1
+                        if field in self.dd_fields[self.dd_key(dd)]:
+                            matched_fields += 1
+                    #comment += ('{} matched {}/{} ').format(entity, matched_fields, total_fields)
+                else:
+                    invalid = True
+                    comment = ('{} not found in profiles').format(entity)
+            else:
+                invalid = True
+                comment = ('{} not found in CIM').format(entity)
+
+        if matched_fields > 0 and not invalid:
+            score = (float(matched_fields) / float(total_fields)) * 100
+
+            if score > 0 and score <= 25:
+                structure_score = 1
+            elif score >= 26 and score <= 50:
+                structure_score = 2
+            elif score >= 51 and score <= 75:
+                structure_score = 3
+            elif score >= 76 and score <= 99:
+                structure_score = 4
+            elif score == 100:
+                structure_score = 5
+
+        return structure_score, comment
+
+    def get_consistency_score(self, dd):
+        """ returns the consistency score of a data dictionary, it only depends on the dictionary """
+        key = self.dd_key(dd)
+        if key in self.consistency_scores:
+            return self.consistency_scores[key]
+
+        total_fields_count = len(dd['data fields'])
+        standard_fields_count = 0
+        consistency_score = 0
+
+        for field in dd['data fields']:
+            if field['standard name']:
+                standard_fields_count += 1
+
+            score = (standard_fields_count / total_fields_count) * 100
+
+            if score >= 0 and score <= 50:
+                consistency_score = 1
+            elif score >= 51 and score <= 99:
+                consistency_score = 3
+            elif score == 100:
+                consistency_score = 5
+
+        self.consistency_scores[key] = consistency_score
+        return consistency_score
+
+    @instrumented
+    def enrich_ddm(self):
+        """ iterate over ddm entries and calculate data quality scores """
+        dcs_snapshot = self.get_dcs_snapshot()
+        profile_snapshot = self.get_profile_snapshot()
+
+        #reuse the results of the previous enrichment for rows whose inputs didn't change
+        full = self.row_channels is None or len(self.row_channels) != len(self.ddm_list)
+        if full:
+            self.row_channels = [None] * len(self.ddm_list)
+            self.row_structures = [None] * len(self.ddm_list)
+            changed_channels = set()
+            changed_entities = set()
+        else:
+            changed_channels = self.changed_keys(self.enriched_dcs, dcs_snapshot)
+            changed_entities = self.changed_keys(self.enriched_profile, profile_snapshot)
+
+        for i, row in enumerate(self.ddm_list):
             # init data quality scoring
             row['coverage'] = 0
             row['timeliness'] = 0
@@ -242,118 +1610,76 @@ class ossemParser():
             row['data channel'] = None
             row['comment'] = ''
 
-            # TODO: some events have the same name across diferent platforms
-            #       in the future OSSEM DDM will need to include OS so that we
-            #       can filter accordingly, otherwise the script might
-            #       incorrectly match an event...
-
-            # find ddm entries for events with data dictionaries
-            dd_matches = list(filter(lambda entry: entry['event'] == event_name, self.data_dictionaries))
-            if dd_matches:
-                dd = dd_matches[0]
-                data_channel = dd['data channel']
-                dcs_matches = list(filter(lambda entry: entry['data channel'] == data_channel, self.data_channels))
-
-                #retrieve data channels scores, otherwise set them to zero
-                if dcs_matches:
-                    dcs = dcs_matches[0]
-                    row['coverage'] = int(dcs['coverage'])
-                    row['timeliness'] = int(dcs['timeliness'])
-                    row['retention'] = int(dcs['retention'])
-                    row['data channel'] = dcs['data channel']
-                else:
-                    row['comment'] = 'data channel not found'
-
-                #calculate structure score
-                matched_fields = 0
-                total_fields = 0
-
-                entities = [
-                    row['source data object'],
-                    row['destination data object']]
-
-                invalid = False
-                missing = 0
-                for entity in entities:
-                    match_cim = list(filter(lambda entry: entry['entity'] == entity, self.cim_entities))
-
-                    if invalid:
-                        continue
-                    elif not entity:
-                        missing += 1
-                        if missing == 2:
-                            row['comment'] = 'both entities are missing'
-                            invalid = True
-                    elif match_cim and not invalid and missing < 2:
-                        match = match_cim[0]
-                        if match['entity'] in self.profile:
-                            for field in self.profile[match['entity']]:
-                                total_fields += 1
-                                field_matches = list(filter(lambda entry: entry['standard name'] == field, dd['data fields']))
-                                if field_matches:
-                                    matched_fields += 1
-                            #row['comment'] += ('{} matched {}/{} ').format(entity, matched_fields, total_fields)
-                        else:
-                            invalid = True
-                            row['comment'] = ('{} not found in profiles').format(entity)
-                    else:
-                        invalid = True
-                        row['comment'] = ('{} not found in CIM').format(entity)
-
-                if matched_fields > 0 and not invalid:
-                    score = (float(matched_fields) / float(total_fields)) * 100
-
-                    if score > 0 and score <= 25:
-                        structure_score = 1
-                    elif score >= 26 and score <= 50:
-                        structure_score = 2
-                    elif score >= 51 and score <= 75:
-                        structure_score = 3
-                    elif score >= 76 and score <= 99:
-                        structure_score = 4
-                    elif score == 100:
-                        structure_score = 5
-                    row['structure'] = structure_score
-
-                #calculate consistency score
-                total_fields_count = len(dd['data fields'])
-                standard_fields_count = 0
-
-                for field in dd['data fields']:
-                    if field['standard name']:
-                        standard_fields_count += 1
-
-                    score = (standard_fields_count / total_fields_count) * 100
-
-                    if score >= 0 and score <= 50:
-                        consistency_score = 1
-                    elif score >= 51 and score <= 99:
-                        consistency_score = 3
-                    elif score == 100:
-                        consistency_score = 5
-
-                row['consistency'] = consistency_score
-
-                #calculate final score
-                average_score = sum((
-                    row['coverage'],
-                    row['timeliness'],
-                    row['retention'],
-                    row['structure'],
-                    row['consistency'])) / 5
-                row['score'] = average_score
-
-            else:
+            # find ddm entries for events with data dictionaries, events shared across
+            # platforms use the first dictionary unless the row or parser has a platform
+            dds = self.get_dictionaries(row)
+            if not dds:
                 row['comment'] = 'data dictionary not found'
+                continue
+            dd = dds[0]
+
+            if full or dd['data channel'] in changed_channels:
+                self.row_channels[i] = self.get_channel_scores(dd)
+
+            if (full or row['source data object'] in changed_entities
+                    or row['destination data object'] in changed_entities):
+                self.row_structures[i] = self.get_structure_score(row, dd)
+
+            coverage, timeliness, retention, data_channel, comment = self.row_channels[i]
+            structure, structure_comment = self.row_structures[i]
+
+            row['coverage'] = coverage
+            row['timeliness'] = timeliness
+            row['retention'] = retention
+            row['data channel'] = data_channel
+            row['structure'] = structure
+            row['consistency'] = self.get_consistency_score(dd)
+            row['comment'] = comment if structure_comment is None else structure_comment
+
+            #calculate final score
+            average_score = sum((
+                row['coverage'],
+                row['timeliness'],
+                row['retention'],
+                row['structure'],
+                row['consistency'])) / 5
+            row['score'] = average_score
+
+        self.enriched_dcs = dcs_snapshot
+        self.enriched_profile = profile_snapshot
 
         return self.ddm_list
 
-    def export_to_xlsx(self, path):
+    def write_sheet(self, wb, title, headers, rows):
+        """ streams rows into a new table sheet of a write-only workbook, returns the row count """
+        from openpyxl.utils import get_column_letter
+        from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+
+        ws = wb.create_sheet(title)
+        ws.append(headers)
+
+        count = 0
+        for row in rows:
+            count += 1
+            ws.append(row)
+
+        #add table, write-only sheets can't read the headers back so columns are set here
+        table = Table(displayName=title, ref="A1:{}{}".format(get_column_letter(len(headers)), count+1))
+        table.tableColumns = [TableColumn(id=i+1, name=header) for i, header in enumerate(headers)]
+        style = TableStyleInfo(name="TableStyleLight15", showRowStripes=True)
+        table.tableStyleInfo = style
+        ws.add_table(table)
+
+        return ws, count
+
+    @instrumented
+    def export_to_xlsx(self, path, extra_sheets=False):
         """Generate XLSX version of the detection data model"""
+        from openpyxl import Workbook
+        from openpyxl.formatting.rule import ColorScaleRule
 
-        wb = Workbook()
-        ws = wb.active
-        ws.append([
+        wb = Workbook(write_only=True)
+        ws, rows = self.write_sheet(wb, 'DDM', [
             'ATT&CK Data Source',
             'Sub Data Source',
             'Source Data Object',
@@ -367,13 +1693,7 @@ class ossemParser():
             'Structure',
             'Consistency',
             'Score',
-            'Comment'])
-
-        rows = 0
-        for entry in self.ddm_list:
-            rows += 1
-
-            ws.append([
+            'Comment'], ([
                 entry['att&ck data source'],
                 entry['sub data source'],
                 entry['source data object'],
@@ -387,21 +1707,57 @@ class ossemParser():
                 entry['structure'],
                 entry['consistency'],
                 entry['score'],
-                entry['comment']])
-
-        #add table
-        table = Table(displayName="DDM", ref="A1:N{}".format(rows+1))
-        style = TableStyleInfo(name="TableStyleLight15", showRowStripes=True)
-        table.tableStyleInfo = style
-        ws.add_table(table)
+                entry['comment']] for entry in self.ddm_list))
 
         #add conditional formating
-        ws.conditional_formatting.add('H2:M10000',
+        ws.conditional_formatting.add('H2:M{}'.format(rows+1),
             ColorScaleRule(
                 start_type='min', start_color='F8696B',
                 mid_type='percentile', mid_value=50, mid_color='FFEB84',
                 end_type='max', end_color='63BE7B'))
 
+        if extra_sheets:
+            self.write_sheet(wb, 'CIM', [
+                'Entity',
+                'Standard Name',
+                'Type',
+                'Description',
+                'Sample Value',
+                'Relevant'], ([
+                    entry['entity'],
+                    entry['standard name'],
+                    entry['type'],
+                    entry['description'],
+                    entry['sample value'],
+                    entry['relevant']] for entry in self.iter_cim_entities()))
+
+            self.write_sheet(wb, 'DDS', [
+                'Data Channel',
+                'Operating System',
+                'Event',
+                'Standard Name',
+                'Field Name',
+                'Type',
+                'Description',
+                'Sample Value'], ([
+                    entry['data channel'],
+                    entry['operating system'],
+                    entry['event'],
+                    entry['standard name'],
+                    entry['field name'],
+                    entry['type'],
+                    entry['description'],
+                    entry['sample value']] for entry in self.iter_dd_list()))
+
+            stats = self.get_ds_stats()
+            self.write_sheet(wb, 'DS', ['ATT&CK Data Source', 'Rows', 'Score'] + [
+                '{} {}'.format(dimension.title(), stat)
+                for dimension in scoreAggregator.dimensions
+                for stat in ('Mean', 'Min', 'Max', 'StdDev')], ([ds, ds_stats['rows'], ds_stats['score']] + [
+                    ds_stats[dimension][stat]
+                    for dimension in scoreAggregator.dimensions
+                    for stat in ('mean', 'min', 'max', 'stddev')] for ds, ds_stats in sorted(stats.items())))
+
         #write new ddm entry
         dt = datetime.now().strftime("%Y%m%d_%H%M%S")
 
@@ -411,163 +1767,713 @@ class ossemParser():
         wb.save('{}ddm_enriched_{}.xlsx'.format(path, dt))
         print('[*] Saved Excel to {}ddm_enriched_{}.xlsx'.format(path, dt))
 
+    @instrumented
     def export_to_yaml(self, path):
         """ generates a yaml version of OSSEM data """
 
-        ddm_yaml = yaml.dump_all(self.ddm_list, sort_keys=False)
-        cim_yaml = yaml.dump_all(self.cim_entities, sort_keys=False)
-        dds_yaml = yaml.dump_all(self.data_dictionaries, sort_keys=False)
-
         dt = datetime.now().strftime("%Y%m%d_%H%M%S")
 
         if not os.path.exists(path):
             os.makedirs(path)
 
-        ddm_yaml_file = open('{}ddm_{}.yml'.format(path, dt), 'w')
-        ddm_yaml_file.write(ddm_yaml)
-        ddm_yaml_file.close()
+        dump_yaml((r.to_dict() for r in self.ddm_list), '{}ddm_{}.yml'.format(path, dt))
         print('[*] Created {}ddm_{}.yml'.format(path, dt))
 
-        cim_yaml_file = open('{}cim_{}.yml'.format(path, dt), 'w')
-        cim_yaml_file.write(cim_yaml)
-        cim_yaml_file.close()
+        dump_yaml((r.to_dict() for r in self.cim_entities), '{}cim_{}.yml'.format(path, dt))
         print('[*] Created {}cim_{}.yml'.format(path, dt))
 
-        dds_yaml_file = open('{}dds_{}.yml'.format(path, dt), 'w')
-        dds_yaml_file.write(dds_yaml)
-        dds_yaml_file.close()
+        dump_yaml((r.to_dict() for r in self.data_dictionaries), '{}dds_{}.yml'.format(path, dt))
         print('[*] Created {}dds_{}.yml'.format(path, dt))
 
         return True
 
-    def export_to_layer(self, path):
-        """ generates a json navigator layer of OSSEM data """
-        ds_scores = self.get_ds_scores()
-        attack = attackCTI(ds_scores)
-        layer = attack.get_ds_quality_layer()
+    @instrumented
+    def export_to_parquet(self, path):
+        """ generates a parquet snapshot of OSSEM data, readable by parse_parquet """
+        schemas = get_parquet_schemas()
+
+        dt = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = '{}snapshot_{}'.format(path, dt)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        write_parquet(self.ddm_list, schemas['ddm'], os.path.join(path, 'ddm.parquet'))
+        write_parquet(self.iter_cim_entities(), schemas['cim'], os.path.join(path, 'cim.parquet'))
+        write_parquet(self.iter_dd_list(), schemas['dds'], os.path.join(path, 'dds.parquet'))
+        write_parquet(({
+            'entity': entity['entity'],
+            'description': entity.get('description'),
+            'field count': len(entity['data fields'] or [])} for entity in self.cim_entities),
+            schemas['cim_entities'], os.path.join(path, 'cim_entities.parquet'))
+        write_parquet(({
+            'operating system': data['operating system'],
+            'data channel': data['data channel'],
+            'description': data.get('description'),
+            'event': data['event'],
+            'field count': len(data['data fields'] or [])} for data in self.data_dictionaries),
+            schemas['data_dictionaries'], os.path.join(path, 'data_dictionaries.parquet'))
+
+        print('[*] Created {}'.format(path))
+        return path
+
+    def iter_ndjson(self):
+        """ yields the records of an ndjson stream, ddm rows first then cim and dictionaries """
+        for row in self.ddm_list:
+            yield dict(record='ddm', **row.to_dict())
+
+        #parents carry their field count, so readers can rebuild the nested model
+        for entity in self.cim_entities:
+            header = {'record': 'cim_entity', 'entity': entity['entity']}
+            if 'description' in entity:
+                header['description'] = entity['description']
+            header['field count'] = len(entity['data fields'] or [])
+            yield header
+        for entry in self.iter_cim_entities():
+            yield dict(record='cim', **entry.to_dict())
+
+        for data in self.data_dictionaries:
+            header = {'record': 'data_dictionary'}
+            for key, value in data.items():
+                if key != 'data fields':
+                    header[key] = value
+            header['field count'] = len(data['data fields'] or [])
+            yield header
+        for entry in self.iter_dd_list():
+            yield dict(record='dds', **entry.to_dict())
+
+    @instrumented
+    def export_to_ndjson(self, path, compression=None):
+        """ streams OSSEM data as json lines to a file, or stdout for '-' """
+        if path != '-':
+            ndjson_dir = os.path.dirname(path)
+            if ndjson_dir and not os.path.exists(ndjson_dir):
+                os.makedirs(ndjson_dir)
+
+        count = 0
+        with open_ndjson(path, 'w', compression) as ndjson_file:
+            for record in self.iter_ndjson():
+                ndjson_file.write(json.dumps(record, default=str))
+                ndjson_file.write('\n')
+                count += 1
+
+        print('[*] Wrote {} records to {}'.format(count, 'stdout' if path == '-' else path))
+        return count
+
+    @instrumented
+    def export_to_layer(self, path, bundle=None, refresh=False, attack=None, domains=('enterprise',), platforms=False):
+        """ generates json navigator layers of OSSEM data, one per domain and optionally per platform """
+        if attack is None:
+            attack = attackCTI(self.get_ds_scores(), bundle=bundle, refresh=refresh)
+
+        print('[*] Generating data source quality layers')
+        layers = attack.get_ds_quality_layers(domains=domains, platforms=platforms)
 
         if not os.path.exists(path):
             os.makedirs(path)
 
         dt = datetime.now().strftime("%Y%m%d_%H%M%S")
-        layer_file = open('{}ds_layer_{}.json'.format(path, dt), 'w')
-        layer_file.write(json.dumps(layer))
-        layer_file.close()
-        print('[*] Created {}ds_layer_{}.json'.format(path, dt))
+        for (domain, platform), layer in sorted(layers.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            #the enterprise layer keeps its original file name
+            parts = []
+            if domain != 'enterprise' or platform:
+                parts.append(domain)
+            if platform:
+                parts.append(platform)
+            name = ''.join(re.sub('[^0-9a-z]+', '', part.lower()) + '_' for part in parts)
+            layer_path = '{}ds_layer_{}{}.json'.format(path, name, dt)
+            with open(layer_path, 'w') as layer_file:
+                layer_file.write(json.dumps(layer))
+            print('[*] Created {}'.format(layer_path))
+
+    @instrumented
+    def export_to_elastic(self, rebuild=False):
+        """ sends the enriched ddm, flatten cim, data dictionaries and data channels to elastic """
+        es = Elastic(
+            chunk_size=CONFIG['ELASTIC_CHUNK_SIZE'],
+            workers=CONFIG['ELASTIC_WORKERS'],
+            manifest=CONFIG['ELASTIC_MANIFEST'])
+
+        exports = [
+            ('ossem.ddm', self.ddm_list, ('eventid', 'data channel')),
+            ('ossem.cim', self.iter_cim_entities(), ('entity', 'standard name')),
+            ('ossem.dds', self.iter_dd_list(), ('operating system', 'data channel', 'event', 'field name')),
+            ('ossem.dcs', self.get_data_channels(), ('data channel',))]
+
+        for index, data, key_fields in exports:
+            if rebuild:
+                es.create(index, data, key_fields)
+            else:
+                es.sync(index, data, key_fields)
+        es.save_manifest()
 
     def get_data_channels(self):
         """ return data channels """
         return self.data_channels
 
-    def get_cim_entities(self):
-        """ return flatten cim list """
-        result = []
+    def get_profile_fields(self):
+        """ returns the (entity, standard name) pairs selected by the profile """
+        return set((entity, field)
+            for entity, fields in self.profile.items() for field in fields or [])
+
+    def iter_cim_entities(self):
+        """ yields the flatten cim one field at a time """
+        profile_fields = self.get_profile_fields()
 
-        #flatten cim into a list
         for entity in self.cim_entities:
+            name = entity['entity']
             for field in entity['data fields']:
+                yield cimEntry.from_values(
+                    name,
+                    field['standard name'],
+                    field['type'],
+                    field['description'],
+                    field['sample value'],
+                    (name, field['standard name']) in profile_fields)
+
+    @instrumented
+    def get_cim_entities(self):
+        """ return flatten cim list """
+        return list(self.iter_cim_entities())
 
-                #check if entity is relevant
-                relevant = False
-                if entity['entity'] in self.profile:
-                    if field['standard name'] in self.profile[entity['entity']]:
-                        relevant = True
-
-                result.append({
-                    'entity': entity['entity'],
-                    'standard name': field['standard name'],
-                    'type': field['type'],
-                    'description': field['description'],
-                    'sample value': field['sample value'],
-                    'relevant': relevant})
-
-        return result
-
-    def get_dd_list(self):
-        """ return flatten data dictionaries """
-        result = []
-
+    def iter_dd_list(self):
+        """ yields the flatten data dictionaries one field at a time """
         for data in self.data_dictionaries:
             data_channel = data['data channel']
             operating_system = data['operating system']
             event = data['event']
 
             for field in data['data fields']:
-                result.append({
-                    'data channel': data_channel,
-                    'operating system': operating_system,
-                    'event': event,
-                    'standard name': field['standard name'],
-                    'field name': field['field name'],
-                    'type': field['type'],
-                    'description': field['description'],
-                    'sample value': field['sample value']})
-
-        return result
+                yield ddEntry.from_values(
+                    data_channel,
+                    operating_system,
+                    event,
+                    field['standard name'],
+                    field['field name'],
+                    field['type'],
+                    field['description'],
+                    field['sample value'])
+
+    @instrumented
+    def get_dd_list(self):
+        """ return flatten data dictionaries """
+        return list(self.iter_dd_list())
 
-    def get_ds_scores(self):
-        """Returns a summary of scores by data source"""
-        data_sources = {}
-        temp_sources = {}
+    def get_ds_aggregate(self):
+        """ aggregates the enriched ddm scores by data source in one pass """
+        aggregate = scoreAggregator(weights=CONFIG.get('SCORE_WEIGHTS'))
+        dimensions = scoreAggregator.dimensions
 
-        #build a dict object to store a summary of data source scores
+        #rows listing several data sources count towards each of them
         for entry in self.ddm_list:
-            dc = entry['att&ck data source']
+            data_sources = split_data_sources(entry['att&ck data source'])
+            if data_sources:
+                row = [entry[dim] for dim in dimensions]
+                for ds in data_sources:
+                    aggregate.add(ds, row)
 
-            if dc == 0:
-                #skip non covered data sources, to avoid polluting the average
-                continue
+        return aggregate
 
-            if dc in data_sources:
-                temp_sources[dc].append((
-                    entry['coverage'],
-                    entry['timeliness'],
-                    entry['retention'],
-                    entry['structure'],
-                    entry['consistency']))
-            else:
-                temp_sources[dc] = [(
-                    entry['coverage'],
-                    entry['timeliness'],
-                    entry['retention'],
-                    entry['structure'],
-                    entry['consistency'])]
+    @instrumented
+    def get_ds_scores(self):
+        """Returns a summary of scores by data source"""
 
         #calculate data quality average for the five dimensions
-        for ds,dq in temp_sources.items():
-            dq_avg = [sum(v) / len(v) for v in zip(*dq)]
-            dq_score = sum(dq_avg) / len(dq_avg)
-            dq_avg.append(dq_score)
-            data_sources[ds.lower()] = dq_avg
+        return self.get_ds_aggregate().means()
 
-        return data_sources
+    def get_ds_stats(self):
+        """ returns rows, mean, min, max and stddev of every dimension by data source """
+        return self.get_ds_aggregate().stats()
 
 
 class Elastic:
-    def __init__(self):
+    def __init__(self, chunk_size=500, workers=1, manifest=None):
+        from elasticsearch import Elasticsearch
+
+        #keep enough pooled connections for every bulk worker
         self.es = Elasticsearch(
             ['{}:{}'.format(CONFIG['ELASTIC_SERVER'], CONFIG['ELASTIC_PORT'])],
-            http_auth=(CONFIG['ELASTIC_USER'],CONFIG['ELASTIC_PASS']))
+            http_auth=(CONFIG['ELASTIC_USER'],CONFIG['ELASTIC_PASS']),
+            maxsize=max(10, workers))
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.manifest_path = manifest
+        self.manifest = {}
+
+        if manifest and os.path.exists(manifest):
+            with open(manifest, 'r') as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def save_manifest(self):
+        """ writes the content hashes of the exported documents """
+        if not self.manifest_path:
+            return False
+
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+
+        with open(self.manifest_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        return True
+
+    def documents(self, data, key_fields):
+        """ yields (id, content hash, entry), ids are derived from the natural key of each entry """
+        for key, entry in natural_keys((record_to_dict(entry) for entry in data), key_fields):
+            doc_hash = hashlib.sha1(json.dumps(entry, sort_keys=True, default=str).encode('utf-8'))
+            yield hashlib.sha1(key.encode('utf-8')).hexdigest(), doc_hash.hexdigest(), entry
+
+    def get_alias_indices(self, alias):
+        """ returns the indices behind an alias, removing a plain index of the same name """
+        if self.es.indices.exists_alias(name=alias):
+            return list(self.es.indices.get_alias(name=alias).keys())
+
+        #indices created before aliases were used have to go before the alias can be added
+        if self.es.indices.exists(index=alias):
+            self.es.indices.delete(index=alias)
+
+        return []
+
+    def bulk(self, actions, raise_on_error=True):
+        """ streams actions using bulk requests, returns the successful actions by op type and the failed ids """
+        from elasticsearch import helpers
+
+        if self.workers > 1:
+            results = helpers.parallel_bulk(self.es, actions,
+                thread_count=self.workers, chunk_size=self.chunk_size,
+                raise_on_error=raise_on_error)
+        else:
+            results = helpers.streaming_bulk(self.es, actions,
+                chunk_size=self.chunk_size, raise_on_error=raise_on_error)
+
+        success = {}
+        failed = []
+        for ok, item in results:
+            op_type, result = next(iter(item.items()))
+            #a document that is already gone counts as deleted
+            if ok or (op_type == 'delete' and result.get('status') == 404):
+                success[op_type] = success.get(op_type, 0) + 1
+            else:
+                failed.append(result.get('_id'))
+
+        return success, failed
 
-    def create(self, index, data):
+    @instrumented
+    def create(self, index, data, key_fields=None):
         print('[*] Creating elastic index {}'.format(index))
 
-        #delete index if exists
-        try:
-            self.es.indices.delete(index)
-        except:
-            pass
+        #load a new index with refresh disabled, index is exposed through an alias
+        target = '{}-{}'.format(index, datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+        self.es.indices.create(index=target, body={
+            'settings': {'index': {'refresh_interval': '-1'}}})
 
-        #create index
-        self.es.indices.create(index)
+        #a failed load must not leave a half filled index with refresh disabled behind
+        try:
+            if key_fields:
+                hashes = {}
+                def actions():
+                    for doc_id, doc_hash, entry in self.documents(data, key_fields):
+                        hashes[doc_id] = doc_hash
+                        yield {'_index': target, '_type': 'entry', '_id': doc_id, '_source': entry}
+                success, failed = self.bulk(actions())
+            else:
+                success, failed = self.bulk({'_index': target, '_type': 'entry', '_source': record_to_dict(entry)}
+                    for entry in data)
+
+            self.es.indices.put_settings(index=target, body={
+                'index': {'refresh_interval': None}})
+            self.es.indices.refresh(index=target)
+        except Exception:
+            self.es.indices.delete(index=target, ignore=[404])
+            raise
+
+        if key_fields:
+            self.manifest[index] = hashes
+
+        #swap alias atomically so the index is never empty
+        old_indices = self.get_alias_indices(index)
+        actions = [{'add': {'index': target, 'alias': index}}]
+        for old_index in old_indices:
+            actions.append({'remove': {'index': old_index, 'alias': index}})
+        self.es.indices.update_aliases(body={'actions': actions})
+
+        for old_index in old_indices:
+            self.es.indices.delete(index=old_index)
+
+        print('[*] Indexed {} documents into {}'.format(sum(success.values()), target))
+        return True
 
-        #pupulate index
-        for entry in data:
-            self.es.index(index=index, doc_type='entry', body=entry)
+    @instrumented
+    def sync(self, index, data, key_fields):
+        """ sends only new, changed and removed documents compared to the manifest """
+        previous = self.manifest.get(index)
+
+        #without a manifest or an index there is nothing to compare against
+        if previous is None or not self.es.indices.exists(index=index):
+            return self.create(index, data, key_fields)
+
+        print('[*] Syncing elastic index {}'.format(index))
+        current = {}
+
+        def actions():
+            for doc_id, doc_hash, entry in self.documents(data, key_fields):
+                current[doc_id] = doc_hash
+                if previous.get(doc_id) != doc_hash:
+                    yield {'_index': index, '_type': 'entry', '_id': doc_id, '_source': entry}
+
+            for doc_id in previous:
+                if doc_id not in current:
+                    yield {'_op_type': 'delete', '_index': index, '_type': 'entry', '_id': doc_id}
+
+        success, failed = self.bulk(actions(), raise_on_error=False)
+        if success:
+            self.es.indices.refresh(index=index)
+
+        #failed documents keep their previous state in the manifest so they are sent again next time
+        if failed:
+            print('[!] {} documents failed to sync into {}'.format(len(failed), index))
+            for doc_id in failed:
+                if doc_id in previous:
+                    current[doc_id] = previous[doc_id]
+                else:
+                    current.pop(doc_id, None)
+        self.manifest[index] = current
 
+        print('[*] Synced {}: {} upserts, {} deletes'.format(
+            index, success.get('index', 0), success.get('delete', 0)))
         return True
 
 
+class snapshotStore:
+    """SQLite history of ddm, data source and technique scores, one snapshot per run"""
+
+    tables = {
+        'ddm_scores': 'key',
+        'ds_scores': 'data_source',
+        'technique_scores': 'technique_id'}
+
+    def __init__(self, path):
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.scores = list(scoreMatrix.dimensions) + ['score']
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY, created TEXT, profile TEXT, version TEXT)''')
+
+        #keyed by snapshot first, so reading one snapshot is a range scan
+        columns = ', '.join('{} REAL'.format(name) for name in self.scores)
+        for table, key in self.tables.items():
+            self.db.execute('''CREATE TABLE IF NOT EXISTS {} (
+                snapshot INTEGER, {} TEXT, {}, PRIMARY KEY (snapshot, {})) WITHOUT ROWID'''.format(
+                table, key, columns, key))
+        self.db.commit()
+
+    def insert(self, table, snapshot, rows):
+        """ inserts (key, scores) rows of a snapshot """
+        self.db.executemany('INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * (len(self.scores) + 2))),
+            ((snapshot, key) + tuple(scores) for key, scores in rows))
+
+    def ddm_rows(self, ddm_list):
+        """ yields the scores of every ddm row keyed by event, channel and sub data source """
+        for key, row in natural_keys(ddm_list, ('eventid', 'data channel', 'sub data source'), ('operating system',)):
+            yield key, [row.get(name) for name in self.scores]
+
+    def save(self, ossem, attack=None, profile=None):
+        """ stores the scores of an enriched parser, returns the snapshot id """
+        cursor = self.db.execute('INSERT INTO snapshots (created, profile, version) VALUES (?, ?, ?)',
+            (datetime.now().isoformat(), profile, __version__))
+        snapshot = cursor.lastrowid
+
+        self.insert('ddm_scores', snapshot, self.ddm_rows(ossem.ddm_list))
+        self.insert('ds_scores', snapshot, ossem.get_ds_scores().items())
+        if attack:
+            self.insert('technique_scores', snapshot, ((technique['technique_id'], attack.get_ds_score(technique['data_sources']))
+                for technique in attack.get_techniques() if 'data_sources' in technique))
+
+        self.db.commit()
+        return snapshot
+
+    def get_snapshots(self):
+        """ returns id, creation date and profile of every snapshot """
+        return self.db.execute('SELECT id, created, profile FROM snapshots ORDER BY id').fetchall()
+
+    def resolve(self, snapshot):
+        """ returns the id of a snapshot, negative numbers count back from the latest one """
+        snapshot = int(snapshot)
+        if snapshot >= 0:
+            if not self.db.execute('SELECT id FROM snapshots WHERE id = ?', (snapshot,)).fetchone():
+                raise KeyError('snapshot {} not found'.format(snapshot))
+            return snapshot
+
+        ids = [row[0] for row in self.db.execute(
+            'SELECT id FROM snapshots ORDER BY id DESC LIMIT ?', (-snapshot,))]
+        if len(ids) < -snapshot:
+            raise KeyError('snapshot {} not found'.format(snapshot))
+        return ids[-1]
+
+    def get_scores(self, table, snapshot):
+        """ returns the scores of a snapshot table by key """
+        rows = self.db.execute('SELECT * FROM {} WHERE snapshot = ?'.format(table), (snapshot,))
+        return dict((row[1], row[2:]) for row in rows)
+
+    def diff(self, old, new):
+        """ returns (table, key, old scores, new scores) for every score that changed """
+        old = self.resolve(old)
+        new = self.resolve(new)
+
+        changes = []
+        for table in self.tables:
+            old_scores = self.get_scores(table, old)
+            new_scores = self.get_scores(table, new)
+            for key in sorted(set(old_scores) | set(new_scores)):
+                before = old_scores.get(key)
+                after = new_scores.get(key)
+                if before is None or after is None or any(
+                        (a or 0) - (b or 0) for a, b in zip(before, after)):
+                    changes.append((table, key, before, after))
+
+        return changes
+
+    def print_diff(self, old, new):
+        """ prints the score deltas between two snapshots, returns the number of changes """
+        changes = self.diff(old, new)
+        print('[*] Comparing snapshot {} with {}'.format(self.resolve(old), self.resolve(new)))
+
+        for table, key, before, after in changes:
+            if before is None:
+                print('[*] {} {}: added, score {}'.format(table, key, after[-1]))
+            elif after is None:
+                print('[!] {} {}: removed, score was {}'.format(table, key, before[-1]))
+            else:
+                deltas = ['{} {:+.2f}'.format(name, (b or 0) - (a or 0))
+                    for name, a, b in zip(self.scores, before, after) if (b or 0) != (a or 0)]
+                #lower scores are regressions
+                level = '!' if (after[-1] or 0) < (before[-1] or 0) else '*'
+                print('[{}] {} {}: {}'.format(level, table, key, ', '.join(deltas)))
+
+        print('[*] {} scores changed'.format(len(changes)))
+        return len(changes)
+
+
+class scoringService:
+    """Resident HTTP service answering scoring queries from the parsed OSSEM model"""
+
+    def __init__(self, ossem, source, profiles, attack, interval=2, platform=None, per_platform=False):
+        self.ossem = ossem
+        self.source = source
+        self.platform = platform
+        self.per_platform = per_platform
+        self.profiles = profiles
+        self.attack = attack
+        self.interval = interval
+        self.techniques = dict((t['technique_id'], t) for t in attack.get_techniques())
+        self.states = {}
+        self.signatures = {}
+
+    def get_source_files(self):
+        """ returns the files the parsed model depends on """
+        mode, path = self.source
+        if mode == 'yaml':
+            return [path+CONFIG['OSSEM_YAML_DDM'], path+CONFIG['OSSEM_YAML_DDS'], path+CONFIG['OSSEM_YAML_CIM']]
+        if mode == 'parquet':
+            return sorted(glob.glob(os.path.join(path, '*.parquet')))
+        if mode == 'ndjson':
+            return [path]
+
+        files = []
+        for root, dirs, names in os.walk(path):
+            files += [os.path.join(root, name) for name in names if name.endswith('.md')]
+        return sorted(files)
+
+    def get_signature(self, files):
+        """ returns the modification times of files, missing files included """
+        return tuple((f, os.stat(f).st_mtime_ns if os.path.exists(f) else None) for f in files)
+
+    def get_signatures(self):
+        """ returns the signatures of every watched group of files """
+        signatures = {
+            'source': self.get_signature(self.get_source_files()),
+            'dcs': self.get_signature(['resources/dcs.yml'])}
+        for name, path in self.profiles.items():
+            signatures[name] = self.get_signature([path])
+        return signatures
+
+    def build_state(self, parser):
+        """ returns the query state of an enriched parser """
+        ds_scores = parser.get_ds_scores()
+        attack = copy.copy(self.attack)
+        attack.set_ds_scores(ds_scores)
+
+        events = {}
+        for row in parser.ddm_list:
+            events.setdefault(str(row['eventid']), []).append(row.to_dict())
+
+        return {'parser': parser, 'ds_scores': ds_scores, 'attack': attack, 'events': events}
+
+    def reload(self, changed):
+        """ rebuilds the states affected by changed file groups, returns the new states """
+        states = dict(self.states)
+
+        if 'source' in changed:
+            print('[*] Reloading OSSEM from {}'.format(self.source[1]))
+            ossem = ossemParser(self.ossem.profile, cache=self.ossem.cache)
+            ossem.data_channels = list(iter_yaml('resources/dcs.yml'))
+            if self.source[0] == 'yaml':
+                ossem.parse_yaml(self.source[1])
+            elif self.source[0] == 'parquet':
+                ossem.parse_parquet(self.source[1])
+            elif self.source[0] == 'ndjson':
+                ossem.parse_ndjson(self.source[1])
+            else:
+                ossem.parse_markdown(self.source[1])
+            if ossem.cache:
+                ossem.cache.save()
+
+            #the reparsed model is matched the same way as the one given at startup
+            if self.platform:
+                ossem.set_platform(self.platform)
+            if self.per_platform:
+                ossem.expand_platforms()
+            self.ossem = ossem
+
+        if 'dcs' in changed:
+            print('[*] Reloading data channels')
+            self.ossem.update_data_channels()
+
+        for name, path in self.profiles.items():
+            if name in states and not changed & set(['source', 'dcs', name]):
+                continue
+
+            print('[*] Scoring profile {}'.format(name))
+            #scored on a copy, queries keep using the current state until it is swapped
+            if name in states and 'source' not in changed:
+                parser = states[name]['parser'].with_profile(path)
+                if 'dcs' in changed:
+                    parser.data_channels = self.ossem.data_channels
+                    parser.index_data_channels()
+            else:
+                parser = self.ossem.with_profile(path)
+
+            parser.enrich_ddm()
+            states[name] = self.build_state(parser)
+
+        return states
+
+    async def watch(self):
+        """ polls watched files and swaps in rebuilt states when they change """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            signatures = await loop.run_in_executor(None, self.get_signatures)
+            changed = set(k for k, v in signatures.items() if self.signatures.get(k) != v)
+            if not changed:
+                continue
+
+            #a failed reload is retried once the files change again, not on every poll
+            self.signatures = signatures
+            try:
+                self.states = await loop.run_in_executor(None, self.reload, changed)
+            except Exception as e:
+                print('[!] Reload failed: {}'.format(e))
+
+    def get_state(self, query):
+        """ returns the state of the profile selected in the query """
+        name = query.get('profile', [next(iter(self.profiles))])[0]
+        if name not in self.states:
+            raise KeyError('profile {} not found'.format(name))
+        return self.states[name]
+
+    def score_dict(self, scores):
+        """ returns a score list keyed by dimension """
+        names = list(scoreMatrix.dimensions) + ['score']
+        return dict(zip(names, scores))
+
+    def route(self, method, target):
+        """ returns the status and json body of a request """
+        if method != 'GET':
+            return 405, {'error': 'method not allowed'}
+
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+
+        if not parts or parts == ['status']:
+            return 200, {
+                'profiles': list(self.profiles),
+                'techniques': len(self.techniques),
+                'ddm': len(self.ossem.ddm_list),
+                'dictionaries': len(self.ossem.data_dictionaries)}
+
+        state = self.get_state(query)
+
+        if parts[0] == 'techniques' and len(parts) == 2:
+            technique = self.techniques.get(parts[1].upper())
+            if not technique:
+                return 404, {'error': 'technique {} not found'.format(parts[1])}
+            scores = [0] * (len(scoreMatrix.dimensions) + 1)
+            if 'data_sources' in technique:
+                scores = state['attack'].get_ds_score(technique['data_sources'])
+            return 200, {
+                'technique_id': technique['technique_id'],
+                'data_sources': technique.get('data_sources', []),
+                'scores': self.score_dict(scores)}
+
+        if parts[0] == 'datasources' and len(parts) == 1:
+            return 200, dict((ds, self.score_dict(scores)) for ds, scores in state['ds_scores'].items())
+
+        if parts[0] == 'datasources' and len(parts) == 2:
+            scores = state['ds_scores'].get(parts[1].lower())
+            if scores is None:
+                return 404, {'error': 'data source {} not found'.format(parts[1])}
+            return 200, self.score_dict(scores)
+
+        if parts[0] == 'events' and len(parts) == 2:
+            if parts[1] not in state['events']:
+                return 404, {'error': 'event {} not found'.format(parts[1])}
+            return 200, state['events'][parts[1]]
+
+        if parts == ['layer']:
+            domain = query.get('domain', ['enterprise'])[0]
+            platform = query.get('platform', [None])[0]
+            if domain not in attackCTI.layer_domains:
+                return 404, {'error': 'domain {} not found'.format(domain)}
+            return 200, state['attack'].get_ds_quality_layer(domain=domain, platform=platform)
+
+        return 404, {'error': 'not found'}
+
+    async def handle(self, reader, writer):
+        """ answers a single HTTP request """
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            method, target, version = request_line.split()
+            status, body = self.route(method, target)
+        except KeyError as e:
+            status, body = 404, {'error': str(e.args[0])}
+        except ValueError:
+            status, body = 400, {'error': 'bad request'}
+
+        data = json.dumps(body).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, 'OK' if status == 200 else 'Error', len(data)).encode('latin-1') + data)
+        await writer.drain()
+        writer.close()
+
+    async def run(self, host, port):
+        """ loads every profile, then serves queries while watching files for changes """
+        import asyncio
+        self.signatures = self.get_signatures()
+        self.states = self.reload(set(self.profiles))
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print('[*] Serving scores on http://{}:{}/'.format(host, port))
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.watch())
+
+
 if __name__ == "__main__":
     logo = """\                                                                                               
                   :                                                                            
@@ -586,64 +2492,222 @@ if __name__ == "__main__":
   ,                      :                                                                     
 
 """
-    print(logo)
     parser = argparse.ArgumentParser(description='A tool to mapped ATT&CK data source coverage, utilising OSSEM.')
     parser.add_argument('-o', '--ossem', 
         help='path to import OSSEM markdown')
     parser.add_argument('-y', '--ossem-yaml',
         help='path to import OSSEM yaml')
+    parser.add_argument('-n', '--ossem-ndjson',
+        help="path to import an OSSEM ndjson stream, '-' reads stdin")
+    parser.add_argument('-s', '--snapshot',
+        help='path to import an OSSEM parquet snapshot')
+    parser.add_argument('-w', '--workers',
+        help='number of processes used to parse OSSEM markdown and score profiles, and threads used for exports',
+        type=int,
+        default=1)
+    parser.add_argument('--timings',
+        help='report the slowest OSSEM markdown files to parse',
+        action='store_true')
     parser.add_argument('-p', '--profile',
         help='path to CIM profile',
         default='profiles/default.yml')
+    parser.add_argument('--profiles',
+        help='directory or glob of CIM profiles to score and compare in one run')
+    parser.add_argument('--platform',
+        help='only match data dictionaries of an operating system, e.g. windows')
+    parser.add_argument('--per-platform',
+        help='score every ddm row once per operating system with a dictionary for its event',
+        action='store_true')
     parser.add_argument('--excel',
         help='export OSSEM DDM to excel',
         action='store_true')
+    parser.add_argument('--excel-all',
+        help='add the flattened CIM and data dictionaries sheets to the excel export',
+        action='store_true')
     parser.add_argument('--elastic',
         help='export OSSEM data models to elastic',
         action='store_true')
+    parser.add_argument('--elastic-rebuild',
+        help='rebuild elastic indices instead of only sending changed documents',
+        action='store_true')
     parser.add_argument('--yaml',
         help='export OSSEM data models to yaml',
         action='store_true')
+    parser.add_argument('--parquet',
+        help='export OSSEM data models to a parquet snapshot',
+        action='store_true')
+    parser.add_argument('--ndjson',
+        help="export OSSEM data models as json lines to a file, '-' writes stdout",
+        metavar='PATH')
+    parser.add_argument('--ndjson-compression',
+        help='compress ndjson input and output, by default picked from a .gz or .zst extension',
+        choices=['gzip', 'zstd'])
+    parser.add_argument('--store',
+        help='save the ddm, data source and technique scores into the snapshot database',
+        action='store_true')
+    parser.add_argument('--diff',
+        help='compare the scores of two stored snapshots, negative ids count back from the latest',
+        nargs=2,
+        metavar=('OLD', 'NEW'))
+    parser.add_argument('--snapshots',
+        help='list the stored snapshots',
+        action='store_true')
     parser.add_argument('--layer',
         help='export OSSEM data models to navigator layer',
         action='store_true')
+    parser.add_argument('--layer-domains',
+        help='ATT&CK matrices to export layers for, ics techniques come from --attack-bundle',
+        nargs='+',
+        choices=['enterprise', 'mobile', 'ics'],
+        default=['enterprise'])
+    parser.add_argument('--layer-platforms',
+        help='also export a layer per platform of every selected matrix',
+        action='store_true')
+    parser.add_argument('--serve',
+        help='keep OSSEM loaded and answer scoring queries over HTTP',
+        action='store_true')
+    parser.add_argument('--port',
+        help='port of the scoring service, it only listens on localhost',
+        type=int,
+        default=8000)
+    parser.add_argument('--attack-bundle',
+        help='path to a local ATT&CK STIX bundle, used instead of MITRE API')
+    parser.add_argument('--attack-refresh',
+        help='pull ATT&CK data again even if the local cache is recent',
+        action='store_true')
+    parser.add_argument('--profile-run',
+        help='write a json report with the time, peak memory and records of every stage',
+        action='store_true')
+    parser.add_argument('--pstats',
+        help='directory to dump a cProfile of every top level stage, implies --profile-run')
+    parser.add_argument('--no-cache',
+        help='parse every OSSEM file again, without reading or updating the parse cache',
+        action='store_true')
     args = parser.parse_args()
 
-    if not args.excel and not args.elastic and not args.yaml and not args.layer:
+    #stdout carries the ndjson records, everything else is printed to stderr
+    if args.ndjson == '-':
+        sys.stdout = sys.stderr
+    print(logo)
+
+    if args.diff or args.snapshots:
+        store = snapshotStore(CONFIG['SNAPSHOT_DB'])
+        if args.snapshots:
+            for snapshot, created, profile in store.get_snapshots():
+                print('[*] {} {} {}'.format(snapshot, created, profile))
+        if args.diff:
+            try:
+                store.print_diff(*args.diff)
+            except (KeyError, ValueError) as e:
+                print('[!] {}'.format(e.args[0]))
+        sys.exit()
+
+    if not args.excel and not args.elastic and not args.yaml and not args.parquet and not args.layer and not args.serve and not args.store and not args.ndjson:
         print('[!] You forgot to select an output. Check the available output arguments with --help.')
         sys.exit()
 
+    #the scoring service reloads from disk, stdin can only be read once
+    if args.serve and not (args.ossem or args.ossem_yaml or args.snapshot or
+            (args.ossem_ndjson and args.ossem_ndjson != '-')):
+        print('[!] --serve needs a markdown, yaml, parquet or ndjson file source to watch')
+        sys.exit(1)
+
+    if args.profile_run or args.pstats:
+        metrics.enable(pstats_path=args.pstats)
+        dt = datetime.now().strftime("%Y%m%d_%H%M%S")
+        atexit.register(metrics.save, 'output/run_profile_{}.json'.format(dt))
+
     print('[*] Profile path: {}'.format(args.profile))
-    ossem = ossemParser(args.profile)
+    cache = None
+    if not args.no_cache:
+        cache = parseCache(CONFIG['CACHE_FILE'], CONFIG['CACHE_MAX_MB'] * 1024 * 1024)
+    ossem = ossemParser(args.profile, cache=cache)
 
     if args.ossem:
         print('[*] Parsing OSSEM from markdown')
-        ddm_list = ossem.parse_markdown(args.ossem)
+        ddm_list = ossem.parse_markdown(args.ossem, workers=args.workers)
+
+        if args.timings:
+            for filepath, elapsed in ossem.get_parse_timings(limit=10):
+                print('[*] {:.3f}s {}'.format(elapsed, filepath))
     elif args.ossem_yaml:
         print('[*] Parsing OSSEM from YAML')
         ddm_list = ossem.parse_yaml(args.ossem_yaml)
-
-    if args.excel:
-        print('[*] Exporting OSSEM DDM to Excel')
-        ddm = ossem.enrich_ddm()
-        path = 'output/'
-        ossem.export_to_xlsx(path)
-
-    elif args.elastic:
-        print('[*] Exporting OSSEM to Elastic')
-        es = Elastic()
-        es.create('ossem.ddm', ossem.enrich_ddm())
-        es.create('ossem.cim', ossem.get_cim_entities())
-        es.create('ossem.dds', ossem.get_dd_list())
-        es.create('ossem.dcs', ossem.get_data_channels())
-
-    elif args.yaml:
-        print('[*] Exporting OSSEM to YAML')
-        path = 'output/'
-        ossem.export_to_yaml(path)
-
-    elif args.layer:
-        print('[*] Exporting OSSEM to ATT&CK Naviagator Layer')
-        path = 'output/'
+    elif args.snapshot:
+        print('[*] Loading OSSEM from parquet snapshot')
+        ddm_list = ossem.parse_parquet(args.snapshot)
+    elif args.ossem_ndjson:
+        print('[*] Loading OSSEM from ndjson')
+        ddm_list = ossem.parse_ndjson(args.ossem_ndjson, compression=args.ndjson_compression)
+
+    if cache:
+        cache.save()
+
+    if args.platform:
+        ossem.set_platform(args.platform)
+    if args.per_platform:
+        ossem.expand_platforms()
+        print('[*] Scoring {} ddm rows across platforms'.format(len(ossem.ddm_list)))
+
+    for (platform, event), keys in ossem.get_ambiguous_events().items():
+        print('[!] Event {} matches {} data dictionaries{}, using {}'.format(
+            event, len(keys), ' on ' + platform if platform else '', '/'.join(keys[0])))
+
+    if args.serve:
+        profile_paths = get_profile_paths(args.profiles) if args.profiles else [args.profile]
+        profiles = dict(zip(get_profile_names(profile_paths), profile_paths))
+        if args.ossem_yaml:
+            source = ('yaml', args.ossem_yaml)
+        elif args.snapshot:
+            source = ('parquet', args.snapshot)
+        elif args.ossem_ndjson and args.ossem_ndjson != '-':
+            source = ('ndjson', args.ossem_ndjson)
+        else:
+            source = ('markdown', args.ossem)
+        attack = attackCTI({}, bundle=args.attack_bundle, refresh=args.attack_refresh)
+        service = scoringService(ossem, source, profiles, attack,
+            platform=args.platform, per_platform=args.per_platform)
+        import asyncio
+        asyncio.run(service.run('127.0.0.1', args.port))
+
+    #parse and enrich once, then every selected export reads the same model
+    attack = None
+    if args.layer or args.store:
+        attack = attackCTI({}, bundle=args.attack_bundle, refresh=args.attack_refresh)
+
+    exports = []
+    if args.profiles:
+        profiles = get_profile_paths(args.profiles)
+        print('[*] Scoring {} profiles'.format(len(profiles)))
+        parsers = ossem.score_profiles(profiles, workers=args.workers)
+
+        if args.elastic:
+            print('[!] Elastic export is not available for multiple profiles')
+            args.elastic = False
+        if args.ndjson == '-':
+            print('[!] ndjson export to stdout is not available for multiple profiles')
+            args.ndjson = None
+
+        for name, profile in zip(get_profile_names(profiles), profiles):
+            profile_parser = parsers[name]
+            profile_attack = None
+            if attack:
+                profile_attack = copy.copy(attack)
+                profile_attack.set_ds_scores(profile_parser.get_ds_scores())
+            exports += get_exports(profile_parser, 'output/profiles/{}/'.format(name), args, profile_attack, profile)
+    else:
+        #every export writes the enriched ddm, as the per profile exports do
         ossem.enrich_ddm()
-        ossem.export_to_layer(path)
+        if attack:
+            attack.set_ds_scores(ossem.get_ds_scores())
+        exports += get_exports(ossem, 'output/', args, attack, args.profile)
+
+    #exports are mostly i/o bound, a few threads are enough even with a single worker,
+    #profiled runs export on the main thread so every export gets its cProfile
+    failed = run_exports(exports, 1 if args.pstats else min(len(exports), max(args.workers, 4)))
+
+    if args.profiles:
+        export_profile_comparison(parsers, 'output/profiles/')
+
+    if failed:
+        sys.exit(1)